@@ -1,18 +1,15 @@
-from Tuple import Canvas, Color, Material, PointLight, Ray, Sphere, Tuple, canvas_to_ppm, lighting, normal_at
+from Tuple import Canvas, Color, Material, PointLight, Ray, Sphere, Tuple, lighting, normal_at, write_ppm
 
 
-def main():
+def draw(canvas_pixels=100):
 
     ray_origin = Tuple(0, 0, -5, 1)
     wall_z = 10
     wall_size = 7.0
-    canvas_pixels = 100
     pixel_size = wall_size / canvas_pixels
     half = wall_size / 2
     canvas = Canvas(canvas_pixels, canvas_pixels) 
 
-    canvas_pixels = 100
-    canvas = Canvas(canvas_pixels, canvas_pixels) 
     shape = Sphere()
     material = Material()
     shape.material=material
@@ -35,9 +32,13 @@ def main():
                 eye = -r.direction
                 color = lighting(hit.object.material, light, point, eye, normal)
                 canvas.write_pixel(x, y, color)
+    return canvas
 
-    with open('sphere.ppm', 'w') as out_file:
-        out_file.write(canvas_to_ppm(canvas))      
+
+def main():
+    canvas = draw()
+    with open('sphere.ppm', 'wb') as out_file:
+        write_ppm(canvas, out_file)      
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -751,4 +751,1175 @@ def test_lighting_with_pattern():
     c2 = lighting(m, light, point(1.1, 0, 0), eye_v, normal_v, False)
 
     assert c1 ==  Color(1, 1, 1)
-    assert c2 ==  Color(0, 0, 0)
\ No newline at end of file
+    assert c2 ==  Color(0, 0, 0)
+
+def test_shape_caches_inverse_transform():
+    s = Sphere()
+    s.set_transform(Matrix.scaling(2, 2, 2))
+    inv = s.inverse_transform
+    assert inv == Matrix.scaling(0.5, 0.5, 0.5)
+    assert s.inverse_transform is inv
+    assert s.inverse_transpose is s.inverse_transpose
+
+def test_shape_transform_change_invalidates_inverse():
+    s = Sphere()
+    s.set_transform(Matrix.scaling(2, 2, 2))
+    assert s.inverse_transform == Matrix.scaling(0.5, 0.5, 0.5)
+    s.transform = Matrix.translation(0, 1, 0)
+    assert s.inverse_transform == Matrix.translation(0, -1, 0)
+    assert s.inverse_transpose == Matrix.translation(0, -1, 0).transpose()
+    assert s.normal_at(point(0, 2, 0)) == vector(0, 1, 0)
+
+def test_plain_shape_constructs():
+    s = Shape()
+    assert s.transform == identity_matrix
+    m = Material(color=Color(1, 0, 0))
+    s.set_material(m)
+    assert s.material is m
+    s.set_transform(Matrix.translation(1, 0, 0))
+    assert s.inverse_transform == Matrix.translation(-1, 0, 0)
+
+def test_transform_factories_produce_matrix4():
+    assert isinstance(identity_matrix, Matrix4)
+    assert isinstance(Matrix.translation(1, 2, 3), Matrix4)
+    assert isinstance(Matrix.scaling(1, 2, 3), Matrix4)
+    assert isinstance(Matrix.rotation_x(1), Matrix4)
+    assert isinstance(Matrix.rotation_y(1), Matrix4)
+    assert isinstance(Matrix.rotation_z(1), Matrix4)
+    assert isinstance(Matrix.shearing(1, 0, 0, 0, 0, 0), Matrix4)
+    t = view_transform(point(1, 3, 2), point(4, -2, 8), vector(1, 1, 0))
+    assert isinstance(t, Matrix4)
+
+def test_matrix4_matches_generic_matrix():
+    rows = [[-5, 2, 6, -8], [1, -5, 1, 8], [7, 7, -6, -7], [1, -3, 7, 4]]
+    a = Matrix4.from_rows(rows)
+    generic = Matrix(4, 4, rows)
+    assert a.determinant() == generic.determinant() == 532
+    assert a.is_invertible()
+    b = a.inverse()
+    assert b[3, 2] == -160 / 532
+    assert b[2, 3] == 105 / 532
+    assert b == Matrix(4, 4, [[0.21805, 0.45113, 0.24060, -0.04511],
+                              [-0.80827, -1.45677, -0.44361, 0.52068],
+                              [-0.07895, -0.22368, -0.05263, 0.19737],
+                              [-0.52256, -0.81391, -0.30075, 0.30639]])
+    assert a * b == identity_matrix
+    assert a * identity_matrix == generic
+    assert a.transpose() == generic.transpose()
+
+def test_matrix4_non_invertible():
+    a = Matrix4.from_rows([[-4, 2, -2, -3], [9, 6, 2, 6], [0, -5, 1, -5], [0, 0, 0, 0]])
+    assert not a.is_invertible()
+    with pytest.raises(ValueError):
+        a.inverse()
+
+def test_inverse_of_combined_transform_with_translation():
+    # A translation column with every entry non-zero is not necessarily a
+    # pure translation; the inverse must still undo the whole transform.
+    t = Matrix.translation(1, 2, 3) * Matrix.scaling(2, 2, 2)
+    p = point(1, 1, 1)
+    assert t.inverse() * (t * p) == p
+    generic = Matrix(4, 4, t.elements)
+    assert generic.inverse() == t.inverse()
+
+def _assert_canvases_close(a, b, tolerance=1e-6):
+    assert (a.width, a.height) == (b.width, b.height)
+    for y in range(a.height):
+        for x in range(a.width):
+            p, q = a.pixel_at(x, y), b.pixel_at(x, y)
+            assert abs(p.red - q.red) < tolerance
+            assert abs(p.green - q.green) < tolerance
+            assert abs(p.blue - q.blue) < tolerance
+
+def test_numpy_engine_matches_python_engine():
+    pytest.importorskip("numpy")
+    w = default_world()
+    c = Camera(21, 11, math.pi / 2)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    _assert_canvases_close(render(c, w, engine="numpy"), render(c, w))
+
+def test_numpy_engine_matches_python_engine_with_plane_and_pattern():
+    pytest.importorskip("numpy")
+    w = default_world()
+    floor = Plane()
+    floor.material = Material()
+    floor.material.pattern = StripePattern(Color(1, 1, 1), Color(0.2, 0.3, 0.4))
+    floor.set_transform(Matrix.translation(0, -1, 0))
+    w.add_object(floor)
+    c = Camera(24, 16, math.pi / 2)
+    c.transform = view_transform(point(1, 1.5, -5), point(0, 0, 0), vector(0, 1, 0))
+    _assert_canvases_close(render(c, w, engine="numpy"), render(c, w))
+
+def test_unknown_render_engine():
+    with pytest.raises(ValueError):
+        render(Camera(2, 2, math.pi / 2), default_world(), engine="gpu")
+
+def test_sphere_batch_intersect_matches_scalar():
+    numpy = pytest.importorskip("numpy")
+    s = Sphere()
+    origins = numpy.array([[0, 0, -5, 1], [0, 1, -5, 1], [0, 2, -5, 1], [0, 0, 0, 1], [0, 0, 5, 1]], dtype=float)
+    directions = numpy.array([[0, 0, 1, 0]] * 5, dtype=float)
+    t0, t1 = s.local_intersect_batch(origins, directions)
+    for i in range(5):
+        xs = s.local_intersect(Ray(Tuple(*origins[i]), Tuple(*directions[i])))
+        if len(xs) == 0:
+            assert numpy.isnan(t0[i]) and numpy.isnan(t1[i])
+        else:
+            assert (t0[i], t1[i]) == (xs[0].t, xs[1].t)
+
+def test_plane_batch_intersect():
+    numpy = pytest.importorskip("numpy")
+    p = Plane()
+    origins = numpy.array([[0, 1, 0], [0, -1, 0], [0, 10, 0]], dtype=float)
+    directions = numpy.array([[0, -1, 0], [0, 1, 0], [0, 0, 1]], dtype=float)
+    t0, t1 = p.local_intersect_batch(origins, directions)
+    assert list(t0[:2]) == [1, 1]
+    assert numpy.isnan(t0[2])
+    assert numpy.isnan(t1).all()
+
+def test_batch_intersect_falls_back_to_scalar():
+    numpy = pytest.importorskip("numpy")
+
+    class Slab(Shape):
+        def local_intersect(self, ray):
+            return Intersections(Intersection(3, self), Intersection(1, self))
+
+    class DentedSphere(Sphere):
+        def local_intersect(self, ray):
+            return Intersections()
+
+    assert batch_intersect_kernel(Slab) is None
+    assert batch_intersect_kernel(DentedSphere) is None
+    t0, t1 = Slab().local_intersect_batch(numpy.zeros((2, 4)), numpy.zeros((2, 4)))
+    assert list(t0) == [1, 1] and list(t1) == [3, 3]
+
+def test_batch_fallback_keeps_the_visible_hit():
+    numpy = pytest.importorskip("numpy")
+
+    class Layers(Shape):
+        def local_intersect(self, ray):
+            return Intersections(*[Intersection(t, self) for t in (3, -1, 1, -3)])
+
+    class Behind(Shape):
+        def local_intersect(self, ray):
+            return Intersections(*[Intersection(t, self) for t in (-1, -2, -3)])
+
+    t0, t1 = Layers().local_intersect_batch(numpy.zeros((2, 4)), numpy.zeros((2, 4)))
+    assert list(t0) == [1, 1] and list(t1) == [3, 3]
+    t0, t1 = Behind().local_intersect_batch(numpy.zeros((1, 4)), numpy.zeros((1, 4)))
+    assert numpy.isnan(t0).all() and numpy.isnan(t1).all()
+
+def test_register_batch_intersect():
+    numpy = pytest.importorskip("numpy")
+
+    class Marker(Shape):
+        def local_intersect(self, ray):
+            return Intersections()
+
+    @register_batch_intersect(Marker)
+    def marker_kernel(shape, origins, directions):
+        return numpy.full(len(origins), 7.0), numpy.full(len(origins), numpy.nan)
+
+    class SubMarker(Marker):
+        pass
+
+    assert batch_intersect_kernel(SubMarker) is marker_kernel
+    t0, _ = SubMarker().local_intersect_batch(numpy.zeros((3, 4)), numpy.zeros((3, 4)))
+    assert list(t0) == [7, 7, 7]
+
+def test_canvas_tiles_cover_canvas_once():
+    for order in ("scanline", "morton", "hilbert"):
+        tiles = canvas_tiles(10, 7, 3, order)
+        covered = [(x, y) for x0, y0, x1, y1 in tiles for y in range(y0, y1) for x in range(x0, x1)]
+        assert sorted(covered) == sorted((x, y) for y in range(7) for x in range(10))
+    with pytest.raises(ValueError):
+        canvas_tiles(10, 7, 3, "spiral")
+
+def test_tile_orders():
+    assert canvas_tiles(4, 4, 2, "morton") == [(0, 0, 2, 2), (2, 0, 4, 2), (0, 2, 2, 4), (2, 2, 4, 4)]
+    tiles = canvas_tiles(8, 8, 1, "hilbert")
+    for (ax, ay, _, _), (bx, by, _, _) in zip(tiles, tiles[1:]):
+        assert abs(ax - bx) + abs(ay - by) == 1
+
+def test_tiled_render_matches_row_render():
+    w = default_world()
+    c = Camera(11, 7, math.pi / 2)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    image = render(c, w, tile_size=4, tile_order="hilbert")
+    for y in range(c.vsize):
+        for x in range(c.hsize):
+            expected = color_at(w, ray_for_pixel(c, x, y))
+            actual = image.pixel_at(x, y)
+            assert (actual.red, actual.green, actual.blue) == (expected.red, expected.green, expected.blue)
+
+def test_parallel_render_is_identical_to_serial():
+    w = default_world()
+    c = Camera(16, 10, math.pi / 2)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    serial = render(c, w)
+    parallel = render(c, w, workers=2, tile_size=3, tile_order="morton")
+    for y in range(c.vsize):
+        for x in range(c.hsize):
+            a, b = serial.pixel_at(x, y), parallel.pixel_at(x, y)
+            assert (a.red, a.green, a.blue) == (b.red, b.green, b.blue)
+
+def test_render_iter_yields_every_tile():
+    w = default_world()
+    c = Camera(9, 5, math.pi / 2)
+    tiles = list(render_iter(c, w, tile_size=(9, 1)))
+    assert [tile for tile, _ in tiles] == [(0, y, 9, y + 1) for y in range(5)]
+    assert all(len(pixels) == 9 for _, pixels in tiles)
+
+def _streamed_ppm(tiles, width, height, background):
+    import io
+    out = io.BytesIO()
+    stream_ppm(tiles, width, height, out, background)
+    return out.getvalue().decode("ascii")
+
+def test_stream_ppm_matches_canvas_to_ppm():
+    w = default_world()
+    c = Camera(11, 7, math.pi / 2)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    expected = canvas_to_ppm(render(c, w))
+    assert _streamed_ppm(render_iter(c, w, tile_size=(11, 1)), 11, 7, False) == expected
+    assert _streamed_ppm(render_iter(c, w, tile_size=3, tile_order="hilbert"), 11, 7, True) == expected
+
+def test_stream_ppm_rejects_incomplete_image():
+    import io
+    tiles = [((0, 0, 2, 1), [(1, 0, 0), (0, 1, 0)])]
+    with pytest.raises(ValueError):
+        stream_ppm(tiles, 2, 2, io.BytesIO())
+
+def test_canvas_to_ppm_splits_long_lines():
+    canvas = Canvas(10, 2)
+    for y in range(2):
+        for x in range(10):
+            canvas.write_pixel(x, y, Color(1, 0.8, 0.6))
+    lines = canvas_to_ppm(canvas).split('\n')
+    assert lines[3] == '255 204 153 255 204 153 255 204 153 255 204 153 255 204 153 255 204'
+    assert lines[4] == '153 255 204 153 255 204 153 255 204 153 255 204 153'
+    assert lines[5] == '255 204 153 255 204 153 255 204 153 255 204 153 255 204 153 255 204'
+    assert lines[6] == '153 255 204 153 255 204 153 255 204 153 255 204 153'
+
+def test_canvas_to_ppm_ends_with_newline():
+    assert canvas_to_ppm(Canvas(5, 3)).endswith('\n')
+
+def test_write_ppm_p6():
+    import io
+    canvas = Canvas(2, 2)
+    canvas.write_pixel(0, 0, Color(1.5, 0, 0))
+    canvas.write_pixel(1, 1, Color(0, 0.5, -1))
+    out = io.BytesIO()
+    write_ppm(canvas, out, "P6")
+    assert out.getvalue() == b'P6\n2 2\n255\n' + bytes([255, 0, 0, 0, 0, 0, 0, 0, 0, 0, 127, 0])
+
+def test_write_ppm_p3_matches_canvas_to_ppm():
+    import io
+    canvas = Canvas(30, 3)
+    canvas.write_pixel(4, 2, Color(0.25, 0.5, 1))
+    out = io.BytesIO()
+    write_ppm(canvas, out)
+    assert out.getvalue().decode('ascii') == canvas_to_ppm(canvas)
+
+def test_read_ppm_round_trip():
+    import io
+    canvas = Canvas(4, 3)
+    canvas.write_pixel(0, 0, Color(1, 0, 0))
+    canvas.write_pixel(3, 2, Color(0, 1, 1))
+    canvas.write_pixel(1, 1, Color(0.2, 0.4, 0.6))
+    for format in ("P3", "P6"):
+        out = io.BytesIO()
+        write_ppm(canvas, out, format)
+        loaded = read_ppm(io.BytesIO(out.getvalue()))
+        assert (loaded.width, loaded.height) == (4, 3)
+        for y in range(3):
+            for x in range(4):
+                assert abs(loaded.pixel_at(x, y).red - canvas.pixel_at(x, y).red) < 1 / 255
+                assert abs(loaded.pixel_at(x, y).blue - canvas.pixel_at(x, y).blue) < 1 / 255
+
+def test_read_ppm_with_comments_and_maxval():
+    import io
+    data = b'P3\n# made by hand\n2 1\n# max\n100\n100 0 50\n0 100 0\n'
+    canvas = read_ppm(io.BytesIO(data))
+    assert canvas.pixel_at(0, 0) == Color(1, 0, 0.5)
+    assert canvas.pixel_at(1, 0) == Color(0, 1, 0)
+
+def test_read_ppm_16_bit_binary():
+    import io
+    data = b'P6\n2 1\n65535\n' + bytes([255, 255, 0, 0, 128, 0, 0, 0, 255, 255, 0, 1])
+    canvas = read_ppm(io.BytesIO(data))
+    assert canvas.pixel_at(0, 0) == Color(1, 0, 32768 / 65535)
+    assert canvas.pixel_at(1, 0) == Color(0, 1, 1 / 65535)
+    with pytest.raises(ValueError):
+        read_ppm(io.BytesIO(data[:-2]))
+    with pytest.raises(ValueError):
+        read_ppm(io.BytesIO(b'P6\n1 1\n70000\n' + bytes(6)))
+
+def test_canvas_is_backed_by_flat_buffer():
+    canvas = Canvas(3, 2)
+    canvas.write_pixel(2, 1, Color(0.25, 0.5, 0.75))
+    view = canvas.buffer()
+    assert len(view) == 3 * 2 * 3
+    assert list(view[15:18]) == [0.25, 0.5, 0.75]
+    view[0] = 1.0
+    assert canvas.pixel_at(0, 0) == Color(1, 0, 0)
+
+def test_canvas_float32():
+    canvas = Canvas(4, 4, dtype="float32")
+    canvas.write_pixel(1, 1, Color(0.1, 0.2, 0.3))
+    assert canvas.buffer().itemsize == 4
+    assert canvas.pixel_at(1, 1) == Color(0.1, 0.2, 0.3)
+    with pytest.raises(ValueError):
+        Canvas(4, 4, dtype="int8")
+
+def test_canvas_rejects_pixels_outside():
+    canvas = Canvas(4, 4)
+    with pytest.raises(IndexError):
+        canvas.write_pixel(4, 0, Color(1, 1, 1))
+    with pytest.raises(IndexError):
+        canvas.pixel_at(0, -1)
+
+def test_canvas_bulk_writes():
+    canvas = Canvas(4, 3)
+    canvas.write_row(1, [1, 0, 0, 0, 1, 0], x=2)
+    canvas.write_tile((0, 0, 2, 2), [(0.1, 0.1, 0.1), (0.2, 0.2, 0.2), (0.3, 0.3, 0.3), (0.4, 0.4, 0.4)])
+    assert canvas.pixel_at(2, 1) == Color(1, 0, 0)
+    assert canvas.pixel_at(3, 1) == Color(0, 1, 0)
+    assert canvas.pixel_at(1, 0) == Color(0.2, 0.2, 0.2)
+    assert canvas.pixel_at(1, 1) == Color(0.4, 0.4, 0.4)
+    assert list(canvas.row(1)[6:]) == [1, 0, 0, 0, 1, 0]
+    with pytest.raises(ValueError):
+        canvas.write_row(0, [1] * 6, x=3)
+
+def test_canvas_numpy_view_shares_memory():
+    pytest.importorskip("numpy")
+    canvas = Canvas(5, 2)
+    pixels = canvas.to_numpy()
+    assert pixels.shape == (2, 5, 3)
+    pixels[1, 4] = (0.5, 0.25, 1)
+    assert canvas.pixel_at(4, 1) == Color(0.5, 0.25, 1)
+
+def test_mapped_canvas_float():
+    with MappedCanvas(4, 3) as canvas:
+        canvas.write_pixel(3, 2, Color(0.1, 2.5, -1))
+        canvas.write_row(0, [0.5, 0.5, 0.5], x=1)
+        assert canvas.pixel_at(3, 2) == Color(0.1, 2.5, -1)
+        assert canvas.pixel_at(1, 0) == Color(0.5, 0.5, 0.5)
+        assert canvas.pixel_at(0, 0) == Color(0, 0, 0)
+
+def test_mapped_canvas_file_is_p6_image(tmp_path):
+    import io
+    path = tmp_path / "image.ppm"
+    reference = Canvas(3, 2)
+    with MappedCanvas(3, 2, dtype="uint8", path=str(path)) as canvas:
+        for x, y, color in [(0, 0, Color(1.5, 0, 0)), (2, 1, Color(0, 0.5, 1)), (1, 1, Color(0.2, 0.4, 0.6))]:
+            canvas.write_pixel(x, y, color)
+            reference.write_pixel(x, y, color)
+        assert canvas.pixel_at(2, 1) == Color(0, 127 / 255, 1)
+        out = io.BytesIO()
+        write_ppm(canvas, out, "P6")
+        canvas.flush()
+        expected = io.BytesIO()
+        write_ppm(reference, expected, "P6")
+        assert out.getvalue() == expected.getvalue()
+        assert path.read_bytes() == expected.getvalue()
+        p3 = io.BytesIO()
+        write_ppm(canvas, p3)
+        assert p3.getvalue().decode("ascii") == canvas_to_ppm(reference)
+
+def test_render_into_mapped_canvas():
+    w = default_world()
+    c = Camera(11, 7, math.pi / 2)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    expected = render(c, w)
+    with MappedCanvas(11, 7) as canvas:
+        assert render(c, w, tile_size=4, canvas=canvas) is canvas
+        assert list(canvas.buffer()) == list(expected.buffer())
+    with pytest.raises(ValueError):
+        render(c, w, canvas=Canvas(3, 3))
+
+def test_shape_bounds():
+    s = Sphere()
+    s.set_transform(Matrix.translation(1, 2, 3) * Matrix.scaling(2, 1, 1))
+    assert s.bounds() == BoundingBox(point(-1, 1, 2), point(3, 3, 4))
+    s.set_transform(Matrix.rotation_z(math.pi / 4))
+    r = math.sqrt(2)
+    assert s.bounds() == BoundingBox(point(-r, -r, -1), point(r, r, 1))
+    assert Plane().bounds() is None
+
+def _random_sphere_world(count, seed=7):
+    import random
+    rng = random.Random(seed)
+    w = World(light=PointLight(point(-10, 10, -10), Color(1, 1, 1)))
+    for _ in range(count):
+        s = Sphere()
+        s.material = Material(color=Color(rng.random(), rng.random(), rng.random()))
+        radius = rng.uniform(0.1, 0.6)
+        s.set_transform(Matrix.translation(rng.uniform(-4, 4), rng.uniform(-4, 4), rng.uniform(-4, 4))
+                        * Matrix.scaling(radius, radius * rng.uniform(0.5, 1.5), radius))
+        w.add_object(s)
+    w.add_object(Plane())
+    return w, rng
+
+def _brute_force_intersections(w, r):
+    xs = []
+    for obj in w.objects:
+        xs.extend((x.t, id(x.object)) for x in obj.intersect(r))
+    return sorted(xs, key=lambda x: x[0])
+
+def test_bvh_intersect_world_matches_brute_force():
+    w, rng = _random_sphere_world(60)
+    assert w.bvh().root is not None
+    for _ in range(200):
+        r = Ray(point(rng.uniform(-6, 6), rng.uniform(-6, 6), rng.uniform(-6, 6)),
+                vector(rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1)).normalize())
+        xs = intersect_world(w, r)
+        assert [(x.t, id(x.object)) for x in xs] == _brute_force_intersections(w, r)
+
+def test_bvh_is_refit_and_rebuilt_when_scene_changes():
+    w, _ = _random_sphere_world(20)
+    r = Ray(point(0, 0, -20), vector(0, 0, 1))
+    bvh = w.bvh()
+    moved = w.objects[0]
+    moved.set_transform(Matrix.translation(0, 0, 10))
+    assert w.bvh() is bvh
+    assert moved in [x.object for x in intersect_world(w, r)]
+    extra = Sphere()
+    extra.set_transform(Matrix.translation(0, 0, 15))
+    w.add_object(extra)
+    assert w.bvh() is not bvh
+    assert extra in [x.object for x in intersect_world(w, r)]
+
+def test_worlds_do_not_share_objects():
+    a = World()
+    a.add_object(Sphere())
+    assert World().objects == []
+
+def test_intersect_ts_matches_intersect():
+    s = Sphere()
+    s.set_transform(Matrix.translation(0, 1, 0) * Matrix.scaling(2, 1, 1))
+    r = Ray(point(-5, 1.5, 0.2), vector(1, 0, 0))
+    assert s.intersect_ts(r) == tuple(x.t for x in s.intersect(r))
+    p = Plane()
+    assert p.intersect_ts(Ray(point(0, 1, 0), vector(0, -1, 0))) == (1,)
+    assert p.intersect_ts(Ray(point(0, 1, 0), vector(1, 0, 0))) == ()
+
+def test_intersect_ts_falls_back_to_local_intersect():
+    class DentedSphere(Sphere):
+        def local_intersect(self, ray):
+            return Intersections(Intersection(42, self))
+    assert DentedSphere().intersect_ts(Ray(point(0, 0, -5), vector(0, 0, 1))) == (42,)
+
+def test_is_occluded_respects_max_distance():
+    w = default_world()
+    assert w.is_occluded(point(0, 0, -5), vector(0, 0, 1), 10)
+    assert not w.is_occluded(point(0, 0, -5), vector(0, 0, 1), 3.9)
+    assert not w.is_occluded(point(0, 0, -5), vector(0, 0, -1), 10)
+
+def test_is_occluded_tries_last_occluder_first():
+    w, rng = _random_sphere_world(30)
+    occluded = 0
+    for _ in range(300):
+        p = point(rng.uniform(-5, 5), rng.uniform(-5, 5), rng.uniform(-5, 5))
+        v = w.light.position - p
+        xs = [x for obj in w.objects for x in obj.intersect(Ray(p, v.normalize()))]
+        brute = any(0 <= x.t < v.magnitude() for x in xs)
+        assert w.is_occluded(p, v.normalize(), v.magnitude()) == brute
+        occluded += brute
+        if brute:
+            assert w._last_occluder is not None
+    assert occluded > 0
+
+def test_removed_object_stops_occluding():
+    w = default_world()
+    assert w.is_occluded(point(0, 0, -5), vector(0, 0, 1), 10)
+    w.objects.pop()
+    w.objects.pop()
+    assert not w.is_occluded(point(0, 0, -5), vector(0, 0, 1), 10)
+
+def test_closest_hit_matches_intersect_world_hit():
+    w, rng = _random_sphere_world(40)
+    hits = 0
+    for _ in range(300):
+        r = Ray(point(rng.uniform(-6, 6), rng.uniform(-6, 6), rng.uniform(-6, 6)),
+                vector(rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1)).normalize())
+        expected = intersect_world(w, r).hit()
+        actual = w.closest_hit(r)
+        if expected is None:
+            assert actual is None
+        else:
+            hits += 1
+            assert (actual.t, actual.object) == (expected.t, expected.object)
+    assert hits > 0
+
+def test_closest_hit_interval():
+    w = default_world()
+    r = Ray(point(0, 0, -5), vector(0, 0, 1))
+    assert w.closest_hit(r).t == 4
+    assert w.closest_hit(r, t_min=4.2).t == 4.5
+    assert w.closest_hit(r, t_min=4.2).object is w.objects[1]
+    assert w.closest_hit(r, t_max=3.5) is None
+    assert w.closest_hit(Ray(point(0, 0, 0), vector(0, 0, 1))).t == 0.5
+
+def test_closest_hit_prefers_earlier_object_on_ties():
+    w = World([Sphere(), Sphere()], PointLight(point(-10, 10, -10), Color(1, 1, 1)))
+    hit = w.closest_hit(Ray(point(0, 0, -5), vector(0, 0, 1)))
+    assert hit.object is w.objects[0]
+
+def test_intersections_sorted_on_access():
+    s = Sphere()
+    xs = Intersections(Intersection(5, s), Intersection(-3, s), Intersection(2, s))
+    assert [x.t for x in xs] == [-3, 2, 5]
+    xs.extend(Intersections(Intersection(1, s), Intersection(7, s)))
+    assert [x.t for x in xs] == [-3, 1, 2, 5, 7]
+    xs.append(Intersection(0.5, s))
+    assert xs[2].t == 1
+    assert xs[1].t == 0.5
+    assert len(xs) == 6
+
+def test_intersections_extend_keeps_insertion_order_for_equal_t():
+    a, b = Sphere(), Sphere()
+    xs = Intersections(Intersection(1, a), Intersection(4, a))
+    xs.extend(Intersections(Intersection(1, b), Intersection(2, b)))
+    assert [(x.t, x.object) for x in xs] == [(1, a), (1, b), (2, b), (4, a)]
+    assert xs.hit().object is a
+
+def test_intersections_hit_is_cached_until_changed():
+    s = Sphere()
+    i1 = Intersection(3, s)
+    xs = Intersections(i1, Intersection(-1, s))
+    assert xs.hit() is i1
+    i2 = Intersection(2, s)
+    xs.append(i2)
+    assert xs.hit() is i2
+    del xs[xs.index(i2)]
+    assert xs.hit() is i1
+    xs[0] = Intersection(0.5, s)
+    assert xs.hit().t == 0.5
+
+def test_intersections_is_mutable_sequence():
+    import collections.abc
+    s = Sphere()
+    xs = Intersections()
+    assert isinstance(xs, collections.abc.MutableSequence)
+    i = Intersection(1, s)
+    xs.insert(0, i)
+    assert i in xs
+    assert xs.pop() is i
+    assert len(xs) == 0
+
+def test_value_types_are_slotted():
+    for value in (point(1, 2, 3), Color(1, 0, 0), Ray(point(0, 0, 0), vector(0, 0, 1))):
+        assert not hasattr(value, "__dict__")
+        with pytest.raises(AttributeError):
+            value.extra = 1
+
+def test_multiply_add_matches_operator_form():
+    p = point(1, 2, 3)
+    v = vector(0.1, -0.7, 2.5)
+    assert p.multiply_add(v, 0.3) == p + v * 0.3
+    assert Ray(p, v).position(1.7) == p + v * 1.7
+
+def test_normalize_into_reuses_tuple():
+    v = vector(4, 0, 3)
+    n = v.normalize()
+    assert v.normalize_into() is v
+    assert (v.x, v.y, v.z, v.w) == (n.x, n.y, n.z, n.w)
+    out = vector(0, 0, 0)
+    w = vector(1, 2, 3)
+    assert w.normalize_into(out) is out
+    assert w == vector(1, 2, 3)
+
+def test_transform_into_may_overwrite_its_input():
+    m = Matrix4.from_matrix(Matrix.translation(5, -3, 2) * Matrix.rotation_y(0.4))
+    p = point(1, 2, 3)
+    expected = m * p
+    assert m.transform_into(p) is p
+    assert p == expected
+
+def test_compile_groups_shapes_by_type():
+    w = default_world()
+    floor = Plane()
+    # A Material of its own: Plane() shares the default Material instance
+    # with every shape created without one.
+    floor.material = Material(pattern=StripePattern(Color(1, 1, 1), Color(0, 0, 0)))
+    w.add_object(floor)
+    assert Plane().material.pattern is None
+    scene = w.compile()
+    assert [g.shape_type for g in scene.groups] == [Sphere, Plane]
+    spheres, planes = scene.groups
+    assert list(spheres.indices) == [0, 1] and list(planes.indices) == [2]
+    assert list(scene.group_ids) == [0, 0, 1] and list(scene.rows) == [0, 1, 0]
+    assert tuple(spheres.inverse_transforms[16:]) == Matrix4.from_matrix(w.objects[1].inverse_transform).m
+    assert tuple(spheres.materials[:7]) == (0.8, 1.0, 0.6, 0.1, 0.7, 0.2, 200)
+    assert list(spheres.pattern_ids) == [-1, -1] and list(planes.pattern_ids) == [0]
+    assert scene.patterns == (floor.material.pattern,)
+    assert tuple(scene.light_position) == (-10, 10, -10, 1)
+
+def test_compile_is_cached_until_world_changes():
+    w = default_world()
+    scene = w.compile()
+    assert w.compile() is scene
+    w.objects[0].transform = Matrix.translation(1, 0, 0)
+    changed = w.compile()
+    assert changed is not scene
+    assert changed.groups[0].inverse_transforms[3] == -1
+    w.add_object(Sphere())
+    assert len(w.compile().group_ids) == 3
+    w.light = PointLight(point(0, 10, 0), Color(1, 1, 1))
+    assert tuple(w.compile().light_position) == (0, 10, 0, 1)
+
+def test_compiled_scene_pickles():
+    import pickle
+    w = default_world()
+    scene = pickle.loads(pickle.dumps(w.compile()))
+    assert list(scene.groups[0].inverse_transforms) == list(w.compile().groups[0].inverse_transforms)
+    w.compile()
+    assert pickle.loads(pickle.dumps(w))._compiled is None
+    # Spheres travel as their inverse, material and four doubles of
+    # geometry, not as whole Shape objects.
+    w, _ = _random_sphere_world(500)
+    world_size = len(pickle.dumps(w))
+    compiled = w.compile()
+    data = pickle.dumps(compiled)
+    assert len(data) < world_size
+    assert len(data) < 300 * len(w.objects)
+    scene = pickle.loads(data)
+    for before, after in zip(compiled.groups, scene.groups):
+        assert after.inverse_transposes == before.inverse_transposes
+        assert len(after.shapes) == len(before.shapes)
+
+def test_numpy_engine_renders_compiled_scene():
+    pytest.importorskip("numpy")
+    w = default_world()
+    c = Camera(11, 11, math.pi / 2)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    tile = (0, 0, 11, 11)
+    assert render_tile(c, w.compile(), tile, engine="numpy") == render_tile(c, w, tile, engine="numpy")
+    _assert_canvases_close(render(c, w, engine="numpy", workers=2, tile_size=4), render(c, w))
+
+def test_render_stats_are_off_by_default():
+    import Tuple as module
+    assert module._stats is None
+    with RenderStats() as stats:
+        assert module._stats is stats
+        with RenderStats() as inner:
+            assert module._stats is inner
+        assert module._stats is stats
+    assert module._stats is None
+
+def test_render_stats_count_rays_and_work():
+    w = default_world()
+    c = Camera(11, 11, math.pi / 2)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    with RenderStats() as stats:
+        render(c, w)
+    assert stats.primary_rays == 121
+    assert stats.shadow_rays == stats.lighting_calls > 0
+    assert stats.shape_tests["Sphere"] > 0
+    assert stats.rays == stats.primary_rays + stats.shadow_rays
+    assert set(stats.timings) == {"render", "tile", "intersect", "shade", "shadow"}
+    assert stats.timings["render"] >= stats.timings["tile"]
+
+def test_render_stats_count_inversions_and_intersection_lists():
+    s = Sphere()
+    with RenderStats() as stats:
+        s.transform = Matrix.translation(1, 2, 3)
+        intersect_world(World([s]), Ray(point(0, 0, -5), vector(0, 0, 1)))
+        s.inverse_transform
+    assert stats.inversions == 1
+    assert stats.intersections_lists >= 1
+    assert stats.timings["intersect"] > 0
+
+def test_render_stats_from_workers_match_serial():
+    w = default_world()
+    c = Camera(12, 8, math.pi / 2)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    with RenderStats() as serial:
+        render(c, w, tile_size=4)
+    with RenderStats() as parallel:
+        render(c, w, workers=2, tile_size=4)
+    assert parallel.primary_rays == serial.primary_rays
+    assert parallel.shadow_rays == serial.shadow_rays
+    assert parallel.lighting_calls == serial.lighting_calls
+
+def test_render_progress_reports_every_tile():
+    w = default_world()
+    c = Camera(10, 6, math.pi / 2)
+    reports = []
+    render(c, w, tile_size=4, progress=lambda done, total, rate: reports.append((done, total, rate)))
+    assert [(done, total) for done, total, _ in reports] == [(1, 6), (2, 6), (3, 6), (4, 6), (5, 6), (6, 6)]
+    assert all(rate >= 0 for _, _, rate in reports)
+
+def test_render_trace_records_setup_and_tiles():
+    w = default_world()
+    c = Camera(8, 8, math.pi / 2)
+    with RenderTrace() as trace:
+        render(c, w, tile_size=4)
+    names = [event["name"] for event in trace.events]
+    assert names == ["scene setup"] + ["tile"] * 4
+    tiles = [event for event in trace.events if event["name"] == "tile"]
+    assert {(e["args"]["x0"], e["args"]["y0"]) for e in tiles} == {(0, 0), (4, 0), (0, 4), (4, 4)}
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in trace.events)
+
+def test_render_trace_merges_worker_spans():
+    import os
+    w = default_world()
+    c = Camera(8, 8, math.pi / 2)
+    with RenderTrace() as trace:
+        render(c, w, workers=2, tile_size=4)
+    tiles = [e for e in trace.events if e["name"] == "tile"]
+    assert len(tiles) == 4
+    assert all(e["pid"] != os.getpid() for e in tiles)
+    startups = [e for e in trace.events if e["name"] == "worker startup"]
+    assert 1 <= len(startups) <= 2
+    assert {e["pid"] for e in startups} <= {e["pid"] for e in tiles}
+
+def test_render_trace_exports_chrome_trace_json():
+    import io, json
+    canvas = Canvas(3, 2)
+    with RenderTrace() as trace:
+        write_ppm(canvas, io.BytesIO())
+    out = io.StringIO()
+    trace.write(out)
+    data = json.loads(out.getvalue())
+    events = data["traceEvents"]
+    assert events[0]["ph"] == "M" and events[0]["args"]["name"] == "main"
+    assert events[1]["name"] == "encode" and events[1]["args"]["width"] == 3
+
+def _ray_components(ray):
+    o, d = ray.origin, ray.direction
+    return (o.x, o.y, o.z, o.w, d.x, d.y, d.z, d.w)
+
+def _odd_camera():
+    c = Camera(13, 7, 1.1)
+    c.transform = view_transform(point(1.3, 2.7, -4.9), point(-0.2, 0.9, 1.4), vector(0.1, 1, 0.2))
+    return c
+
+def test_camera_caches_inverse_and_origin():
+    c = Camera(201, 101, math.pi / 2)
+    c.transform = Matrix.rotation_y(math.pi / 4) * Matrix.translation(0, -2, 5)
+    inverse = c.inverse_transform
+    assert c.inverse_transform is inverse
+    assert c.origin == point(0, 2, -5)
+    c.transform = Matrix.translation(1, 0, 0)
+    assert c.origin == point(-1, 0, 0)
+
+def test_tile_rays_match_ray_for_pixel_exactly():
+    c = _odd_camera()
+    rays = list(tile_rays(c, 2, 1, 9, 6))
+    expected = [ray_for_pixel(c, x, y) for y in range(1, 6) for x in range(2, 9)]
+    assert [_ray_components(r) for r in rays] == [_ray_components(r) for r in expected]
+    assert [_ray_components(r) for r in row_rays(c, 3)] == [_ray_components(ray_for_pixel(c, x, 3)) for x in range(13)]
+
+def test_primary_rays_numpy_match_ray_for_pixel_exactly():
+    pytest.importorskip("numpy")
+    c = _odd_camera()
+    origins, directions = primary_rays_numpy(c, 2, 1, 9, 6)
+    expected = [_ray_components(ray_for_pixel(c, x, y)) for y in range(1, 6) for x in range(2, 9)]
+    assert [tuple(o) + tuple(d) for o, d in zip(origins.tolist(), directions.tolist())] == expected
+
+def test_render_adaptive_with_one_sample_matches_render():
+    w = default_world()
+    c = Camera(11, 11, math.pi / 2)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    image, samples = render_adaptive(c, w, max_samples=1)
+    assert samples == 1
+    assert list(image.data) == list(render(c, w).data)
+
+def test_render_adaptive_supersamples_only_edges():
+    w = World([Sphere()], PointLight(point(-10, 10, -10), Color(1, 1, 1)))
+    c = Camera(21, 21, math.pi / 3)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    plain = render(c, w)
+    image, samples = render_adaptive(c, w, threshold=0.2, max_samples=16)
+    assert 1 < samples < 4
+    # Far from the silhouette the pixels keep their single sample.
+    assert image.pixel_at(0, 0) == plain.pixel_at(0, 0) == Color(0, 0, 0)
+    assert image.pixel_at(10, 10) == plain.pixel_at(10, 10)
+    # On the silhouette some pixels end up between the sphere and black.
+    changed = [(x, y) for y in range(21) for x in range(21) if image.pixel_at(x, y) != plain.pixel_at(x, y)]
+    assert changed
+
+def test_render_adaptive_rejects_bad_budget():
+    c = Camera(4, 4, math.pi / 2)
+    with pytest.raises(ValueError):
+        render_adaptive(c, default_world(), max_samples=0)
+    for budget in (2, 3, 5, 8, 15, 32):
+        with pytest.raises(ValueError):
+            render_adaptive(c, default_world(), max_samples=budget)
+    with pytest.raises(ValueError):
+        render_adaptive(c, default_world(), threshold=-1)
+
+def test_lighting_batch_matches_scalar_lighting():
+    numpy = pytest.importorskip("numpy")
+    r2 = math.sqrt(2) / 2
+    patterned = Material(ambient=1, diffuse=0, specular=0, pattern=StripePattern(Color(1, 1, 1), Color(0, 0, 0)))
+    shiny = Material(color=Color(0.8, 1.0, 0.6), diffuse=0.7, specular=0.2, shininess=50)
+    # (material, light position, point, eyev, normalv, in_shadow), covering
+    # the scalar lighting tests plus a shadowed hit and a custom material.
+    cases = [
+        (Material(), point(0, 0, -10), point(0, 0, 0), vector(0, 0, -1), vector(0, 0, -1), False),
+        (Material(), point(0, 0, -10), point(0, 0, 0), vector(0, r2, -r2), vector(0, 0, -1), False),
+        (Material(), point(0, 10, -10), point(0, 0, 0), vector(0, 0, -1), vector(0, 0, -1), False),
+        (Material(), point(0, 10, -10), point(0, 0, 0), vector(0, -r2, -r2), vector(0, 0, -1), False),
+        (Material(), point(0, 0, 10), point(0, 0, 0), vector(0, 0, -1), vector(0, 0, -1), False),
+        (Material(), point(0, 0, -10), point(0, 0, 0), vector(0, 0, -1), vector(0, 0, -1), True),
+        (patterned, point(0, 0, -10), point(0.9, 0, 0), vector(0, 0, -1), vector(0, 0, -1), False),
+        (patterned, point(0, 0, -10), point(1.1, 0, 0), vector(0, 0, -1), vector(0, 0, -1), False),
+        (shiny, point(-10, 10, -10), point(0.3, 0.4, -0.866), vector(0.1, 0.2, -0.97), vector(0.3, 0.4, -0.866), False),
+    ]
+    rows = lambda ts: numpy.array([[t.x, t.y, t.z, t.w] for t in ts])
+    surface = [m.pattern.pattern_at(p) if m.pattern else m.color for m, _, p, _, _, _ in cases]
+    for light_position in {(c[1].x, c[1].y, c[1].z) for c in cases}:
+        subset = [i for i, c in enumerate(cases) if (c[1].x, c[1].y, c[1].z) == light_position]
+        light = PointLight(point(*light_position), Color(1, 1, 1))
+        result = lighting_batch(
+            (light.position.x, light.position.y, light.position.z, 1), (1, 1, 1),
+            rows(cases[i][2] for i in subset), rows(cases[i][3] for i in subset), rows(cases[i][4] for i in subset),
+            [cases[i][5] for i in subset], [(surface[i].red, surface[i].green, surface[i].blue) for i in subset],
+            [cases[i][0].ambient for i in subset], [cases[i][0].diffuse for i in subset],
+            [cases[i][0].specular for i in subset], [cases[i][0].shininess for i in subset])
+        for row, i in zip(result.tolist(), subset):
+            m, _, p, eyev, normalv, in_shadow = cases[i]
+            expected = lighting(m, light, p, eyev, normalv, in_shadow)
+            assert row == [expected.red, expected.green, expected.blue]
+
+def test_lighting_batch_broadcasts_scalar_materials():
+    numpy = pytest.importorskip("numpy")
+    points = numpy.array([[0, 0, 0, 1]] * 3, dtype=float)
+    eyev = numpy.array([[0, 0, -1, 0]] * 3, dtype=float)
+    normals = numpy.array([[0, 0, -1, 0]] * 3, dtype=float)
+    result = lighting_batch((0, 0, -10, 1), (1, 1, 1), points, eyev, normals, [False, True, False],
+                            numpy.ones((3, 3)), 0.1, 0.9, 0.9, 200)
+    assert numpy.allclose(result, [[1.9] * 3, [0.1] * 3, [1.9] * 3])
+
+white = Color(1, 1, 1)
+black = Color(0, 0, 0)
+
+def test_stripe_pattern_alternates_across_negative_x():
+    pattern = StripePattern(white, black)
+    assert pattern.pattern_at(point(0, 0, 0)) == white
+    assert pattern.pattern_at(point(0.9, 0, 0)) == white
+    assert pattern.pattern_at(point(1, 0, 0)) == black
+    assert pattern.pattern_at(point(-0.1, 0, 0)) == black
+    assert pattern.pattern_at(point(-1, 0, 0)) == black
+    assert pattern.pattern_at(point(-1.1, 0, 0)) == white
+
+def test_gradient_ring_and_checkers_patterns():
+    gradient = GradientPattern(white, black)
+    assert gradient.pattern_at(point(0.25, 0, 0)) == Color(0.75, 0.75, 0.75)
+    assert gradient.pattern_at(point(0.75, 0, 0)) == Color(0.25, 0.25, 0.25)
+    ring = RingPattern(white, black)
+    assert ring.pattern_at(point(0, 0, 0)) == white
+    assert ring.pattern_at(point(1, 0, 0)) == black
+    assert ring.pattern_at(point(0, 0, 1)) == black
+    assert ring.pattern_at(point(0.708, 0, 0.708)) == black
+    checkers = CheckersPattern(white, black)
+    assert checkers.pattern_at(point(0.99, 0, 0)) == white
+    assert checkers.pattern_at(point(1.01, 0, 0)) == black
+    assert checkers.pattern_at(point(0, 0.99, 0)) == white
+    assert checkers.pattern_at(point(0, 0, 1.01)) == black
+
+def test_pattern_with_object_and_pattern_transformations():
+    shape = Sphere()
+    shape.set_transform(Matrix.scaling(2, 2, 2))
+    pattern = StripePattern(white, black)
+    assert pattern.pattern_at_object(shape, point(1.5, 0, 0)) == white
+    pattern.transform = Matrix.scaling(2, 2, 2)
+    assert pattern.pattern_at_object(None, point(1.5, 0, 0)) == white
+    pattern.transform = Matrix.translation(0.5, 0, 0)
+    assert pattern.pattern_at_object(shape, point(2.5, 0, 0)) == white
+    inverse = pattern.inverse_transform
+    assert pattern.inverse_transform is inverse
+
+def test_shade_hit_evaluates_patterns_in_object_space():
+    w = World([], PointLight(point(0, 0, -10), Color(1, 1, 1)))
+    s = Sphere()
+    s.material = Material(ambient=1, diffuse=0, specular=0, pattern=StripePattern(white, black))
+    s.set_transform(Matrix.scaling(2, 2, 2) * Matrix.translation(0.75, 0, 0))
+    w.add_object(s)
+    # World x = 1.5 is object x = 0, the start of a white stripe; unscaled
+    # world-space stripes would make it black.
+    assert color_at(w, Ray(point(1.5, 0, -10), vector(0, 0, 1))) == white
+
+def test_pattern_at_batch_matches_pattern_at():
+    numpy = pytest.importorskip("numpy")
+    points = [point(x / 3, y / 5, z / 7) for x in range(-4, 5) for y in (-2, 3) for z in (-6, 1, 6)]
+    array = numpy.array([[p.x, p.y, p.z, p.w] for p in points])
+    for pattern in (StripePattern(white, black), GradientPattern(Color(1, 0, 0), Color(0, 0, 1)),
+                    RingPattern(white, black), CheckersPattern(white, black)):
+        expected = [pattern.pattern_at(p) for p in points]
+        assert pattern.pattern_at_batch(array).tolist() == [[c.red, c.green, c.blue] for c in expected]
+
+def test_pattern_base_batch_falls_back_to_pattern_at():
+    numpy = pytest.importorskip("numpy")
+    class PositionPattern(Pattern):
+        def pattern_at(self, point):
+            return Color(point.x, point.y, point.z)
+    colors = PositionPattern(white, black).pattern_at_batch(numpy.array([[1, 2, 3, 1], [0.5, 0, -1, 1]], dtype=float))
+    assert colors.tolist() == [[1, 2, 3], [0.5, 0, -1]]
+
+def test_pattern_base_is_abstract():
+    with pytest.raises(TypeError):
+        Pattern(white, black)
+
+    class NoPatternAt(Pattern):
+        pass
+
+    with pytest.raises(TypeError):
+        NoPatternAt(white, black)
+
+def test_numpy_engine_matches_python_engine_with_transformed_patterns():
+    pytest.importorskip("numpy")
+    w = default_world()
+    floor = Plane()
+    floor.material = Material(pattern=CheckersPattern(white, Color(0.2, 0.3, 0.4)))
+    floor.material.pattern.transform = Matrix.rotation_y(0.5) * Matrix.scaling(0.7, 0.7, 0.7)
+    floor.set_transform(Matrix.translation(0, -1, 0))
+    w.add_object(floor)
+    w.objects[0].material = Material(pattern=RingPattern(Color(1, 0, 0), white, Matrix.scaling(0.2, 0.2, 0.2)))
+    c = Camera(24, 16, math.pi / 2)
+    c.transform = view_transform(point(1, 1.5, -5), point(0, 0, 0), vector(0, 1, 0))
+    _assert_canvases_close(render(c, w, engine="numpy"), render(c, w))
+
+def _max_difference(a, b):
+    return max(abs(x - y) for x, y in zip(Matrix4.from_matrix(a).m, Matrix4.from_matrix(b).m))
+
+def test_transform_composes_in_application_order():
+    t = Transform().rotate_x(math.pi / 2).scale(5, 5, 5).translate(10, 5, 7)
+    assert t * point(1, 0, 1) == point(15, 0, 7)
+    assert t == Matrix.translation(10, 5, 7) * Matrix.scaling(5, 5, 5) * Matrix.rotation_x(math.pi / 2)
+    assert Transform() == identity_matrix
+    assert Transform().translate(1, 2, 3) * Transform().scale(2, 2, 2) == Transform().scale(2, 2, 2).translate(1, 2, 3)
+
+def test_transform_inverse_matches_general_inverse():
+    chains = [
+        Transform().scale(10, 0.01, 10).rotate_x(math.pi / 2).rotate_y(-math.pi / 4).translate(0, 0, 5),
+        Transform().scale(0.33, 0.33, 0.33).translate(1.5, 0.33, -0.75),
+        Transform().rotate_z(0.3).scale(2, -3, 0.5).rotate_y(1.1).translate(-4, 2, 9).rotate_x(-0.7),
+        Transform().shear(1, 0.5, 0, 0.2, 0.1, 0).rotate_y(0.4).scale(3, 1, 2).translate(1, 1, 1),
+    ]
+    for t in chains:
+        analytic = t.inverse()
+        general = Matrix4(t.m).inverse()
+        assert _max_difference(analytic, general) < 1e-12
+        assert _max_difference(analytic * t, identity_matrix) < 1e-12
+
+def test_transform_inverse_needs_no_general_inversion_without_shearing():
+    t = Transform().scale(2, 4, 8).rotate_y(0.5).translate(1, 2, 3)
+    with RenderStats() as stats:
+        t.inverse()
+    assert stats.inversions == 0
+    assert t.inverse() is t.inverse()
+    with pytest.raises(ValueError):
+        Transform().scale(0, 1, 1).inverse()
+
+def test_shape_accepts_transform_chain():
+    s = Sphere()
+    s.transform = Transform().scale(2, 2, 2).translate(5, 0, 0)
+    xs = intersect(s, Ray(point(0, 0, -5), vector(0, 0, 1)))
+    assert len(xs) == 0
+    xs = intersect(s, Ray(point(5, 0, -5), vector(0, 0, 1)))
+    assert [x.t for x in xs] == [3, 7]
+    assert s.normal_at(point(5, 2, 0)) == vector(0, 1, 0)
+
+def test_transform_points_matches_tuple_multiplication():
+    m = Transform().rotate_x(0.3).scale(2, 3, 4).translate(1, -2, 5)
+    tuples = [point(1, 2, 3), vector(1, 2, 3), point(-0.5, 0, 7), Tuple(1, 1, 1, 0.5)]
+    result = m.transform_points(tuples)
+    assert [(t.x, t.y, t.z, t.w) for t in result] == [((m * t).x, (m * t).y, (m * t).z, (m * t).w) for t in tuples]
+    # Vectors are not translated.
+    assert Matrix.translation(5, 5, 5).transform_points([vector(1, 0, 0)]) == [vector(1, 0, 0)]
+    assert Matrix.translation(5, 5, 5).transform_points([]) == []
+
+def test_transform_points_on_arrays():
+    numpy = pytest.importorskip("numpy")
+    m = Matrix.translation(1, 2, 3) * Matrix.rotation_z(0.7)
+    tuples = [point(1, 2, 3), vector(0, 1, 0), point(0, 0, 0)]
+    array = numpy.array([[t.x, t.y, t.z, t.w] for t in tuples])
+    result = m.transform_points(array)
+    assert result.shape == (3, 4)
+    assert result.tolist() == [[t.x, t.y, t.z, t.w] for t in m.transform_points(tuples)]
+    with pytest.raises(ValueError):
+        m.transform_points(numpy.zeros((3, 3)))
+
+def test_transform_points_needs_4x4_matrix():
+    with pytest.raises(ValueError):
+        Matrix(3, 3, [[1, 0, 0], [0, 1, 0], [0, 0, 1]]).transform_points([point(0, 0, 0)])
+
+def test_instance_matches_transformed_shape():
+    prototype = Sphere()
+    prototype.transform = Matrix.scaling(2, 1, 1)
+    instance = Instance(prototype, Matrix.translation(0, 0, 5))
+    direct = Sphere()
+    direct.transform = Matrix.translation(0, 0, 5) * Matrix.scaling(2, 1, 1)
+    r = Ray(point(1, 0.5, -5), vector(0, 0, 1))
+    assert [x.t for x in instance.intersect(r)] == [x.t for x in direct.intersect(r)]
+    assert instance.intersect_ts(r) == direct.intersect_ts(r)
+    assert instance.bounds() == direct.bounds()
+    xs = instance.intersect(r)
+    assert xs[0].object is instance and xs[0].inner.object is prototype
+    p = r.position(xs[0].t)
+    assert normal_at(instance, p, xs[0]) == normal_at(direct, p)
+    assert instance.material is prototype.material
+    override = Material(color=Color(1, 0, 0))
+    assert Instance(prototype, material=override).material is override
+
+def test_instance_is_small():
+    import pickle
+    import tracemalloc
+    prototype = Sphere()
+    transforms = [Matrix.translation(i, 0, 0) * Matrix.scaling(0.5, 0.5, 0.5) for i in range(500)]
+    r = Ray(point(0, 0, -5), vector(0, 0, 1))
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        instances = [Instance(prototype, t) for t in transforms]
+        for instance in instances:
+            intersect(instance, r)
+            instance.intersect_ts(r)
+            instance.bounds()
+            instance.normal_at(point(0, 0, -0.5))
+        per_instance = (tracemalloc.get_traced_memory()[0] - before) / len(instances)
+    finally:
+        tracemalloc.stop()
+    # The object itself plus one array of 24 doubles: about 400 bytes,
+    # against about 1.7 KB for a Sphere with its cached matrices.
+    assert per_instance < 450
+    assert not hasattr(instances[0], "__dict__")
+    copy = pickle.loads(pickle.dumps(instances[3]))
+    assert copy.transform == transforms[3] and copy.inverse_transform == transforms[3].inverse()
+    with pytest.raises(ValueError):
+        Instance(prototype, Matrix4([1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 1, 1]))
+
+def test_instances_of_group_share_its_bvh():
+    w, _ = _random_sphere_world(40)
+    group = Group(w.objects[:-1], transform=Matrix.scaling(0.5, 0.5, 0.5))
+    bvh = group.bvh()
+    world = World(light=w.light)
+    for x in (-3, 3):
+        world.add_object(Instance(group, Matrix.translation(x, 0, 0)))
+    world.add_object(w.objects[-1])
+    c = Camera(16, 12, math.pi / 2)
+    c.transform = view_transform(point(0, 1, -12), point(0, 0, 0), vector(0, 1, 0))
+    image = render(c, world)
+    assert group.bvh() is bvh
+    # The same scene with every sphere copied into world space.
+    flat = World(light=w.light)
+    for x in (-3, 3):
+        for child in group.children:
+            s = Sphere()
+            s.transform = Matrix.translation(x, 0, 0) * group.transform * child.transform
+            s.material = child.material
+            flat.add_object(s)
+    flat.add_object(w.objects[-1])
+    _assert_canvases_close(image, render(c, flat))
+
+def test_group_add_child_refits_world():
+    w, _ = _random_sphere_world(9)
+    g = Group([Sphere()])
+    w.add_object(g)
+    far = Sphere()
+    far.transform = Matrix.translation(0, 50, 0)
+    w.bvh()
+    g.add_child(far)
+    r = Ray(point(0, 45, 0), vector(0, 1, 0))
+    assert w.closest_hit(r).t == 4
+    assert intersect_world(w, r).hit().t == 4
+
+def test_group_normal_needs_the_hit():
+    s = Sphere()
+    s.transform = Matrix.translation(5, 0, 0)
+    g = Group([s], transform=Matrix.scaling(2, 2, 2))
+    r = Ray(point(10, 0, -10), vector(0, 0, 1))
+    xs = g.intersect(r)
+    assert [x.t for x in xs] == [8, 12]
+    assert xs[0].inner.object is s
+    assert normal_at(g, r.position(8), xs[0]) == vector(0, 0, -1)
+    with pytest.raises(ValueError):
+        g.normal_at(point(10, 0, -2))
+
+def test_group_hits_shade_with_the_child_material():
+    light = PointLight(point(-10, 10, -10), Color(1, 1, 1))
+    red, blue = Sphere(), Sphere()
+    red.material = Material(color=Color(1, 0, 0))
+    blue.material = Material(color=Color(0, 0, 1))
+    blue.transform = Matrix.translation(3, 0, 0)
+    r = Ray(point(0, 0, -5), vector(0, 0, 1))
+    expected = color_at(World([red], light), r)
+    g = Group([red, blue])
+    assert color_at(World([g], light), r) == expected
+    assert color_at(World([Instance(g)], light), r) == expected
+    green = Material(color=Color(0, 1, 0))
+    outer = Instance(Instance(g, material=green), material=Material(color=Color(1, 1, 0)))
+    inner_only = Instance(Instance(g, material=green))
+    assert color_at(World([inner_only], light), r).green > 0.5
+    assert color_at(World([outer], light), r).red > 0.5
+
+def test_group_patterns_use_the_child_space():
+    light = PointLight(point(-10, 10, -10), Color(1, 1, 1))
+    child = Sphere()
+    child.transform = Matrix.scaling(2, 2, 2)
+    child.material = Material(pattern=StripePattern(Color(1, 1, 1), Color(0, 0, 0)))
+    g = Group([child], transform=Matrix.translation(0.3, 0, 0))
+    flat = Sphere()
+    flat.transform = g.transform * child.transform
+    flat.material = child.material
+    for x in (-1.5, -0.5, 0.2, 0.9):
+        r = Ray(point(x, 0, -5), vector(0, 0, 1))
+        assert color_at(World([Instance(g, Matrix.translation(0, 0, 1))], light), r) == \
+            color_at(World([Instance(flat, Matrix.translation(0, 0, 1))], light), r)
+
+def test_numpy_engine_rejects_groups_up_front():
+    pytest.importorskip("numpy")
+    c = Camera(4, 4, math.pi / 2)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    for shape in (Group([Sphere()]), Instance(Instance(Group([Sphere()])))):
+        w = World([Sphere(), shape], PointLight(point(-10, 10, -10), Color(1, 1, 1)))
+        with pytest.raises(ValueError, match="Groups"):
+            next(render_iter(c, w, engine="numpy"))
+    w = World([Instance(Sphere())], PointLight(point(-10, 10, -10), Color(1, 1, 1)))
+    _assert_canvases_close(render(c, w, engine="numpy"), render(c, w))
+
+def test_numpy_engine_matches_python_for_instances():
+    pytest.importorskip("numpy")
+    prototype = Sphere()
+    prototype.transform = Matrix.translation(0.4, 0, 0) * Matrix.scaling(1, 0.7, 1)
+    prototype.material = Material(pattern=StripePattern(Color(1, 1, 1), Color(0.1, 0.2, 0.3),
+                                                        Matrix.scaling(0.3, 0.3, 0.3)))
+    w = World([Instance(prototype, Matrix.translation(-1.5, 0, 0) * Matrix.rotation_z(0.5)),
+               Instance(Instance(prototype, Matrix.translation(1.5, 0, 0)),
+                        material=Material(color=Color(0.2, 0.8, 0.3))),
+               Plane()], PointLight(point(-10, 10, -10), Color(1, 1, 1)))
+    c = Camera(24, 16, math.pi / 2)
+    c.transform = view_transform(point(0, 1.5, -5), point(0, 0, 0), vector(0, 1, 0))
+    _assert_canvases_close(render(c, w, engine="numpy"), render(c, w))
+
+def test_compiled_scene_follows_world_edits():
+    pytest.importorskip("numpy")
+    w = default_world()
+    c = Camera(11, 11, math.pi / 2)
+    c.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    render(c, w, engine="numpy")
+    w.objects.pop()
+    assert len(w.compile().group_ids) == 1
+    w.objects[0].material.color = Color(0.2, 0.3, 0.9)
+    _assert_canvases_close(render(c, w, engine="numpy"), render(c, w))
+
+def test_numpy_engine_uses_overridden_normals():
+    pytest.importorskip("numpy")
+
+    class Bumpy(Sphere):
+        def local_normal_at(self, local_point):
+            return vector(local_point.x + 0.5, local_point.y, local_point.z)
+
+    class Tilted(Plane):
+        def local_normal_at(self, point):
+            return vector(0.3, 1, 0)
+
+    w = World([Bumpy(), Tilted()], PointLight(point(-10, 10, -10), Color(1, 1, 1)))
+    w.objects[1].transform = Matrix.translation(0, -1, 0)
+    c = Camera(16, 12, math.pi / 2)
+    c.transform = view_transform(point(0, 1, -5), point(0, 0, 0), vector(0, 1, 0))
+    _assert_canvases_close(render(c, w, engine="numpy"), render(c, w))
@@ -1,8 +1,25 @@
 import math
-import collections
+import collections.abc
 import abc
+import contextlib
+import json
+import os
+import queue
+import threading
+import mmap
+import tempfile
+import time
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class Tuple:
+    __slots__ = ("x", "y", "z", "w")
+
     def __init__(self, x, y, z, w):
         self.x = x
         self.y = y
@@ -30,9 +47,24 @@ class Tuple:
     def __truediv__(self, scalar):
         return Tuple(self.x / scalar, self.y / scalar, self.z / scalar, self.w / scalar)
     def magnitude(self):
-        return math.sqrt(self.x**2 + self.y**2 + self.z**2 + self.w**2)
+        return math.sqrt(self.x * self.x + self.y * self.y + self.z * self.z + self.w * self.w)
     def normalize(self):
-        return Tuple(self.x / self.magnitude(),self.y / self.magnitude(),self.z / self.magnitude(),self.w)
+        magnitude = self.magnitude()
+        return Tuple(self.x / magnitude, self.y / magnitude, self.z / magnitude, self.w)
+
+    # Fused and in-place variants for the render hot path; each saves one or
+    # more temporary Tuples compared to the operator form.
+    def multiply_add(self, other, scalar):
+        # self + other * scalar
+        return Tuple(self.x + other.x * scalar, self.y + other.y * scalar,
+                     self.z + other.z * scalar, self.w + other.w * scalar)
+    def normalize_into(self, out=None):
+        # Writes the normalized vector into out (self by default) and returns it.
+        if out is None:
+            out = self
+        magnitude = self.magnitude()
+        out.x, out.y, out.z, out.w = self.x / magnitude, self.y / magnitude, self.z / magnitude, self.w
+        return out
     def dot(self,b):
         return self.x *b.x + self.y *b.y +self.z *b.z 
     def cross(self, other):
@@ -50,7 +82,7 @@ class Matrix:
 
     @staticmethod
     def translation(x, y, z):
-        return Matrix(4, 4, [
+        return Matrix4.from_rows([
             [1, 0, 0, x],
             [0, 1, 0, y],
             [0, 0, 1, z],
@@ -59,7 +91,7 @@ class Matrix:
 
     @staticmethod
     def scaling(x, y, z):
-        return Matrix(4, 4, [
+        return Matrix4.from_rows([
             [x, 0, 0, 0],
             [0, y, 0, 0],
             [0, 0, z, 0],
@@ -70,7 +102,7 @@ class Matrix:
     def rotation_x(radians):
         c = math.cos(radians)
         s = math.sin(radians)
-        return Matrix(4, 4, [
+        return Matrix4.from_rows([
             [1, 0, 0, 0],
             [0, c, -s, 0],
             [0, s, c, 0],
@@ -81,7 +113,7 @@ class Matrix:
     def rotation_y(radians):
         c = math.cos(radians)
         s = math.sin(radians)
-        return Matrix(4, 4, [
+        return Matrix4.from_rows([
             [c, 0, s, 0],
             [0, 1, 0, 0],
             [-s, 0, c, 0],
@@ -92,7 +124,7 @@ class Matrix:
     def rotation_z(radians):
         c = math.cos(radians)
         s = math.sin(radians)
-        return Matrix(4, 4, [
+        return Matrix4.from_rows([
             [c, -s, 0, 0],
             [s, c, 0, 0],
             [0, 0, 1, 0],
@@ -101,7 +133,7 @@ class Matrix:
     
     @staticmethod
     def shearing(xy, xz, yx, yz, zx, zy):
-        return Matrix(4, 4, [
+        return Matrix4.from_rows([
             [1, xy, xz, 0],
             [yx, 1, yz, 0],
             [zx, zy, 1, 0],
@@ -140,9 +172,11 @@ class Matrix:
         if self.rows != self.cols:
             raise ValueError("Matrix must be square")
         
-        if self.rows == 4 and self.cols == 4 and self.elements[0][3] != 0 and self.elements[1][3] != 0 and self.elements[2][3] != 0:
-            return Matrix.translation(-self.elements[0][3], -self.elements[1][3], -self.elements[2][3])
+        if self.rows == 4:
+            return Matrix4.from_matrix(self).inverse()
         else:
+            if _stats is not None:
+                _stats.inversions += 1
             determinant = self.determinant()
             if determinant == 0:
                 raise ValueError("Matrix is not invertible")
@@ -170,20 +204,26 @@ class Matrix:
     def __eq__(self, other):
         if self.rows != other.rows or self.cols != other.cols:
             return False
+        a = self.elements
+        b = other.elements
         for i in range(self.rows):
             for j in range(self.cols):
-                if abs(self.elements[i][j] - other.elements[i][j])> 0.01:
+                if abs(a[i][j] - b[i][j])> 0.01:
                     return False
         return True
     def __mul__(self, other):
         if isinstance(other, Matrix):
             if self.cols != other.rows:
                 raise ValueError("Matrix dimensions are incompatible for multiplication")
+            if self.rows == 4 and self.cols == 4 and other.cols == 4:
+                return Matrix4.from_matrix(self) * Matrix4.from_matrix(other)
+            a = self.elements
+            b = other.elements
             result = [[0 for _ in range(other.cols)] for _ in range(self.rows)]
             for i in range(self.rows):
                 for j in range(other.cols):
                     for k in range(self.cols):
-                        result[i][j] += self.elements[i][k] * other.elements[k][j]
+                        result[i][j] += a[i][k] * b[k][j]
             return Matrix(self.rows, other.cols, result)
         elif isinstance(other, Tuple):
             if self.cols != 4:
@@ -198,14 +238,283 @@ class Matrix:
     def transpose(self):
         return Matrix(self.cols, self.rows, [[self.elements[j][i] for j in range(self.rows)] for i in range(self.cols)])
 
+    def transform_points(self, points):
+        # Applies the matrix to many points or vectors at once, honouring
+        # each one's w. An (n, 4) numpy array gives an (n, 4) array; any
+        # other sequence of Tuples gives a list of Tuples. Either way every
+        # result equals self * point exactly.
+        if self.rows != 4 or self.cols != 4:
+            raise ValueError("Matrix must be 4x4 to multiply with a tuple")
+        m0, m1, m2, m3, m4, m5, m6, m7, m8, m9, m10, m11, m12, m13, m14, m15 = Matrix4.from_matrix(self).m
+        if np is not None and isinstance(points, np.ndarray):
+            if points.ndim != 2 or points.shape[1] != 4:
+                raise ValueError("Points must be an (n, 4) array")
+            x, y, z, w = points[:, 0], points[:, 1], points[:, 2], points[:, 3]
+            return np.stack([m0 * x + m1 * y + m2 * z + m3 * w,
+                             m4 * x + m5 * y + m6 * z + m7 * w,
+                             m8 * x + m9 * y + m10 * z + m11 * w,
+                             m12 * x + m13 * y + m14 * z + m15 * w], axis=1)
+        result = []
+        for p in points:
+            x, y, z, w = p.x, p.y, p.z, p.w
+            result.append(Tuple(m0 * x + m1 * y + m2 * z + m3 * w,
+                                m4 * x + m5 * y + m6 * z + m7 * w,
+                                m8 * x + m9 * y + m10 * z + m11 * w,
+                                m12 * x + m13 * y + m14 * z + m15 * w))
+        return result
+
+
+class Matrix4(Matrix):
+    # 4x4 matrix stored as a flat row-major tuple. Matrix4 values are never
+    # mutated, so the determinant is computed at most once.
+    rows = 4
+    cols = 4
+
+    def __init__(self, values):
+        self.m = tuple(values)
+        if len(self.m) != 16:
+            raise ValueError("Matrix4 needs exactly 16 elements")
+        self._determinant = None
+
+    @staticmethod
+    def from_rows(rows):
+        return Matrix4([element for row in rows for element in row])
+
+    @staticmethod
+    def from_matrix(matrix):
+        if isinstance(matrix, Matrix4):
+            return matrix
+        if matrix.rows != 4 or matrix.cols != 4:
+            raise ValueError("Matrix must be 4x4")
+        return Matrix4.from_rows(matrix.elements)
+
+    @property
+    def elements(self):
+        m = self.m
+        return [list(m[0:4]), list(m[4:8]), list(m[8:12]), list(m[12:16])]
+
+    def __getitem__(self, index):
+        row, col = index
+        return self.m[row * 4 + col]
+
+    def __eq__(self, other):
+        if not isinstance(other, Matrix4):
+            return super().__eq__(other)
+        for a, b in zip(self.m, other.m):
+            if abs(a - b) > 0.01:
+                return False
+        return True
+
+    def __mul__(self, other):
+        if isinstance(other, Tuple):
+            m = self.m
+            x, y, z, w = other.x, other.y, other.z, other.w
+            return Tuple(m[0] * x + m[1] * y + m[2] * z + m[3] * w,
+                         m[4] * x + m[5] * y + m[6] * z + m[7] * w,
+                         m[8] * x + m[9] * y + m[10] * z + m[11] * w,
+                         m[12] * x + m[13] * y + m[14] * z + m[15] * w)
+        if isinstance(other, Matrix):
+            if other.rows != 4:
+                raise ValueError("Matrix dimensions are incompatible for multiplication")
+            if other.cols != 4:
+                return super().__mul__(other)
+            a00, a01, a02, a03, a10, a11, a12, a13, a20, a21, a22, a23, a30, a31, a32, a33 = self.m
+            b00, b01, b02, b03, b10, b11, b12, b13, b20, b21, b22, b23, b30, b31, b32, b33 = Matrix4.from_matrix(other).m
+            return Matrix4((
+                a00 * b00 + a01 * b10 + a02 * b20 + a03 * b30,
+                a00 * b01 + a01 * b11 + a02 * b21 + a03 * b31,
+                a00 * b02 + a01 * b12 + a02 * b22 + a03 * b32,
+                a00 * b03 + a01 * b13 + a02 * b23 + a03 * b33,
+                a10 * b00 + a11 * b10 + a12 * b20 + a13 * b30,
+                a10 * b01 + a11 * b11 + a12 * b21 + a13 * b31,
+                a10 * b02 + a11 * b12 + a12 * b22 + a13 * b32,
+                a10 * b03 + a11 * b13 + a12 * b23 + a13 * b33,
+                a20 * b00 + a21 * b10 + a22 * b20 + a23 * b30,
+                a20 * b01 + a21 * b11 + a22 * b21 + a23 * b31,
+                a20 * b02 + a21 * b12 + a22 * b22 + a23 * b32,
+                a20 * b03 + a21 * b13 + a22 * b23 + a23 * b33,
+                a30 * b00 + a31 * b10 + a32 * b20 + a33 * b30,
+                a30 * b01 + a31 * b11 + a32 * b21 + a33 * b31,
+                a30 * b02 + a31 * b12 + a32 * b22 + a33 * b32,
+                a30 * b03 + a31 * b13 + a32 * b23 + a33 * b33))
+        return NotImplemented
+
+    def transform_into(self, t, out=None):
+        # self * t written into out (t itself by default); out may be t.
+        if out is None:
+            out = t
+        m = self.m
+        x, y, z, w = t.x, t.y, t.z, t.w
+        out.x = m[0] * x + m[1] * y + m[2] * z + m[3] * w
+        out.y = m[4] * x + m[5] * y + m[6] * z + m[7] * w
+        out.z = m[8] * x + m[9] * y + m[10] * z + m[11] * w
+        out.w = m[12] * x + m[13] * y + m[14] * z + m[15] * w
+        return out
+
+    def __truediv__(self, scalar):
+        if scalar == 0:
+            raise ValueError("Division by zero")
+        return Matrix4([element / scalar for element in self.m])
 
-identity_matrix = Matrix(4, 4, [
-    [1, 0, 0, 0],
-    [0, 1, 0, 0],
-    [0, 0, 1, 0],
-    [0, 0, 0, 1]
-])
+    def transpose(self):
+        m = self.m
+        return Matrix4((m[0], m[4], m[8], m[12],
+                        m[1], m[5], m[9], m[13],
+                        m[2], m[6], m[10], m[14],
+                        m[3], m[7], m[11], m[15]))
+
+    def _pair_products(self):
+        # 2x2 determinants of the top two and bottom two rows; every cofactor
+        # of a 4x4 matrix is a combination of these twelve values.
+        a00, a01, a02, a03, a10, a11, a12, a13, a20, a21, a22, a23, a30, a31, a32, a33 = self.m
+        s = (a00 * a11 - a10 * a01,
+             a00 * a12 - a10 * a02,
+             a00 * a13 - a10 * a03,
+             a01 * a12 - a11 * a02,
+             a01 * a13 - a11 * a03,
+             a02 * a13 - a12 * a03)
+        c = (a20 * a31 - a30 * a21,
+             a20 * a32 - a30 * a22,
+             a20 * a33 - a30 * a23,
+             a21 * a32 - a31 * a22,
+             a21 * a33 - a31 * a23,
+             a22 * a33 - a32 * a23)
+        return s, c
+
+    def determinant(self):
+        if self._determinant is None:
+            s, c = self._pair_products()
+            self._determinant = (s[0] * c[5] - s[1] * c[4] + s[2] * c[3]
+                                 + s[3] * c[2] - s[4] * c[1] + s[5] * c[0])
+        return self._determinant
+
+    def is_invertible(self):
+        return self.determinant() != 0
+
+    def inverse(self):
+        if _stats is not None:
+            _stats.inversions += 1
+        a00, a01, a02, a03, a10, a11, a12, a13, a20, a21, a22, a23, a30, a31, a32, a33 = self.m
+        (s0, s1, s2, s3, s4, s5), (c0, c1, c2, c3, c4, c5) = self._pair_products()
+        if self._determinant is None:
+            self._determinant = s0 * c5 - s1 * c4 + s2 * c3 + s3 * c2 - s4 * c1 + s5 * c0
+        determinant = self._determinant
+        if determinant == 0:
+            raise ValueError("Matrix is not invertible")
+
+        return Matrix4((
+            (a11 * c5 - a12 * c4 + a13 * c3) / determinant,
+            (-a01 * c5 + a02 * c4 - a03 * c3) / determinant,
+            (a31 * s5 - a32 * s4 + a33 * s3) / determinant,
+            (-a21 * s5 + a22 * s4 - a23 * s3) / determinant,
+            (-a10 * c5 + a12 * c2 - a13 * c1) / determinant,
+            (a00 * c5 - a02 * c2 + a03 * c1) / determinant,
+            (-a30 * s5 + a32 * s2 - a33 * s1) / determinant,
+            (a20 * s5 - a22 * s2 + a23 * s1) / determinant,
+            (a10 * c4 - a11 * c2 + a13 * c0) / determinant,
+            (-a00 * c4 + a01 * c2 - a03 * c0) / determinant,
+            (a30 * s4 - a31 * s2 + a33 * s0) / determinant,
+            (-a20 * s4 + a21 * s2 - a23 * s0) / determinant,
+            (-a10 * c3 + a11 * c1 - a12 * c0) / determinant,
+            (a00 * c3 - a01 * c1 + a02 * c0) / determinant,
+            (-a30 * s3 + a31 * s1 - a32 * s0) / determinant,
+            (a20 * s3 - a21 * s1 + a22 * s0) / determinant))
+
+
+identity_matrix = Matrix4((1, 0, 0, 0,
+                           0, 1, 0, 0,
+                           0, 0, 1, 0,
+                           0, 0, 0, 1))
+
+class Transform(Matrix4):
+    # A Matrix4 built from a chain of primitive transformations, listed in
+    # the order they apply to a point:
+    #
+    #     Transform().scale(10, 0.01, 10).rotate_x(math.pi / 2).translate(0, 0, 5)
+    #
+    # is translation * rotation_x * scaling. Transforms are immutable; each
+    # method returns a longer chain. The matrix is composed on first use and
+    # the inverse is composed from the inverses of the primitives in
+    # reverse order, so it needs no general 4x4 inversion unless the chain
+    # contains a shearing.
+    def __init__(self, steps=()):
+        self.steps = tuple(steps)
+        self._m = None
+        self._inverse = None
+        self._determinant = None
+
+    @property
+    def m(self):
+        if self._m is None:
+            matrix = identity_matrix
+            for name, args in self.steps:
+                matrix = _TRANSFORM_STEPS[name](*args) * matrix
+            self._m = matrix.m
+        return self._m
+
+    def _then(self, name, *args):
+        return Transform(self.steps + ((name, args),))
+
+    def translate(self, x, y, z):
+        return self._then("translate", x, y, z)
+
+    def scale(self, x, y, z):
+        return self._then("scale", x, y, z)
+
+    def rotate_x(self, radians):
+        return self._then("rotate_x", radians)
+
+    def rotate_y(self, radians):
+        return self._then("rotate_y", radians)
+
+    def rotate_z(self, radians):
+        return self._then("rotate_z", radians)
+
+    def shear(self, xy, xz, yx, yz, zx, zy):
+        return self._then("shear", xy, xz, yx, yz, zx, zy)
+
+    def __mul__(self, other):
+        # Composing two chains keeps the result a Transform.
+        if isinstance(other, Transform):
+            return Transform(other.steps + self.steps)
+        return super().__mul__(other)
+
+    def inverse(self):
+        if self._inverse is None:
+            inverse = identity_matrix
+            for name, args in self.steps:
+                inverse = inverse * _inverse_step(name, args)
+            self._inverse = inverse
+        return self._inverse
+
+    def __repr__(self):
+        return "Transform()" + "".join(f".{name}({', '.join(map(repr, args))})" for name, args in self.steps)
+
+_TRANSFORM_STEPS = {
+    "translate": Matrix.translation,
+    "scale": Matrix.scaling,
+    "rotate_x": Matrix.rotation_x,
+    "rotate_y": Matrix.rotation_y,
+    "rotate_z": Matrix.rotation_z,
+    "shear": Matrix.shearing,
+}
+
+def _inverse_step(name, args):
+    if name == "translate":
+        x, y, z = args
+        return Matrix.translation(-x, -y, -z)
+    if name == "scale":
+        x, y, z = args
+        if x == 0 or y == 0 or z == 0:
+            raise ValueError("Matrix is not invertible")
+        return Matrix.scaling(1 / x, 1 / y, 1 / z)
+    if name in ("rotate_x", "rotate_y", "rotate_z"):
+        # A rotation's inverse is its transpose.
+        return _TRANSFORM_STEPS[name](*args).transpose()
+    return _TRANSFORM_STEPS[name](*args).inverse()
 class Color:
+    __slots__ = ("red", "green", "blue")
+
     def __init__(self, red, green, blue):
         self.red = red
         self.green = green
@@ -245,18 +554,104 @@ class PointLight:
         return self.intensity == other.intensity  and self.position == other.position
 
 
-class StripePattern:
-    def __init__(self, a, b):
+class Pattern(abc.ABC):
+    # Base for two-color patterns. pattern_at works in pattern space;
+    # pattern_at_object maps a world point there through the object's and
+    # the pattern's inverse transforms, which are cached like Shape's.
+    def __init__(self, a, b, transform=identity_matrix):
         self.a = a
         self.b = b
+        self.transform = transform
+
+    @property
+    def transform(self):
+        return self._transform
+
+    @transform.setter
+    def transform(self, t):
+        self._transform = t
+        self._inverse = None
 
+    @property
+    def inverse_transform(self):
+        if self._inverse is None:
+            self._inverse = Matrix4.from_matrix(self._transform.inverse())
+        return self._inverse
+
+    @abc.abstractmethod
+    def pattern_at(self, point):
+        pass
+
+    def pattern_at_object(self, object, world_point):
+        # With object=None the point is taken to be in object space already.
+        object_point = world_point if object is None else object.inverse_transform * world_point
+        return self.pattern_at(self.inverse_transform * object_point)
+
+    def pattern_at_batch(self, points):
+        # Pattern-space points as an (n, 3) or (n, 4) array -> (n, 3) colors.
+        # Subclasses override this with array expressions.
+        _require_numpy()
+        colors = np.empty((len(points), 3))
+        for i, (x, y, z) in enumerate(np.asarray(points)[:, :3].tolist()):
+            c = self.pattern_at(point(x, y, z))
+            colors[i] = (c.red, c.green, c.blue)
+        return colors
+
+    def _choose_batch(self, use_a):
+        a = np.array([self.a.red, self.a.green, self.a.blue])
+        b = np.array([self.b.red, self.b.green, self.b.blue])
+        return np.where(use_a[:, None], a, b)
+
+class StripePattern(Pattern):
+    def pattern_at(self, point):
+        if math.floor(point.x) % 2 == 0:
+            return self.a
+        else:
+            return self.b
+
+    def pattern_at_batch(self, points):
+        _require_numpy()
+        points = np.asarray(points, dtype=float)
+        return self._choose_batch(np.floor(points[:, 0]) % 2 == 0)
+
+class GradientPattern(Pattern):
+    def pattern_at(self, point):
+        fraction = point.x - math.floor(point.x)
+        return self.a + (self.b - self.a) * fraction
+
+    def pattern_at_batch(self, points):
+        _require_numpy()
+        x = np.asarray(points, dtype=float)[:, 0]
+        a = np.array([self.a.red, self.a.green, self.a.blue])
+        b = np.array([self.b.red, self.b.green, self.b.blue])
+        return a + (b - a) * (x - np.floor(x))[:, None]
+
+class RingPattern(Pattern):
     def pattern_at(self, point):
-        stripe_width = 1.0
-        if int(point.x / stripe_width) % 2 == 0:
+        if math.floor(math.sqrt(point.x * point.x + point.z * point.z)) % 2 == 0:
             return self.a
         else:
             return self.b
 
+    def pattern_at_batch(self, points):
+        _require_numpy()
+        points = np.asarray(points, dtype=float)
+        x, z = points[:, 0], points[:, 2]
+        return self._choose_batch(np.floor(np.sqrt(x * x + z * z)) % 2 == 0)
+
+class CheckersPattern(Pattern):
+    def pattern_at(self, point):
+        if (math.floor(point.x) + math.floor(point.y) + math.floor(point.z)) % 2 == 0:
+            return self.a
+        else:
+            return self.b
+
+    def pattern_at_batch(self, points):
+        _require_numpy()
+        points = np.asarray(points, dtype=float)
+        floors = np.floor(points[:, :3])
+        return self._choose_batch((floors[:, 0] + floors[:, 1] + floors[:, 2]) % 2 == 0)
+
 class Material:
     def __init__(self, color=Color(1, 1, 1), ambient=0.1, diffuse=0.9, specular=0.9, shininess=200,pattern=None):
         self.color = color
@@ -266,35 +661,173 @@ class Material:
         self.shininess = shininess
         self.pattern = pattern
 
+class BoundingBox:
+    # Axis-aligned box between two corner points.
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __eq__(self, other):
+        return self.minimum == other.minimum and self.maximum == other.maximum
+
+    def corners(self):
+        lo, hi = self.minimum, self.maximum
+        return [point(x, y, z) for x in (lo.x, hi.x) for y in (lo.y, hi.y) for z in (lo.z, hi.z)]
+
+    def transform(self, matrix):
+        # Smallest box containing all eight transformed corners.
+        corners = matrix.transform_points(self.corners())
+        return BoundingBox(point(min(c.x for c in corners), min(c.y for c in corners), min(c.z for c in corners)),
+                           point(max(c.x for c in corners), max(c.y for c in corners), max(c.z for c in corners)))
+
 class Shape:
+    # Bumped whenever any shape gets a new transform, so that cached scene
+    # data (see World.bvh) can tell cheaply whether it is stale.
+    generation = 0
+
+    # Subclasses that do not declare __slots__ get a __dict__ as usual;
+    # Instance declares them so that it has none.
+    __slots__ = ("_transform", "_inverse", "_inverse_transpose", "_bounds", "material", "saved_ray")
+
     def __init__(self,transform=identity_matrix,material = Material()):
         self.transform = transform
         self.material=material
 
+    @property
+    def transform(self):
+        return self._transform
+
+    @transform.setter
+    def transform(self, t):
+        # Any new transform drops the cached inverses; they are rebuilt on first use.
+        self._transform = t
+        self._inverse = None
+        self._inverse_transpose = None
+        self._bounds = None
+        Shape.generation += 1
+
+    @property
+    def inverse_transform(self):
+        if self._inverse is None:
+            self._inverse = self._transform.inverse()
+        return self._inverse
+
+    @property
+    def inverse_transpose(self):
+        if self._inverse_transpose is None:
+            self._inverse_transpose = self.inverse_transform.transpose()
+        return self._inverse_transpose
+
     def intersect(self,ray):
-         transformed_ray = ray.transform(self.transform.inverse())
+         if _stats is not None:
+             _stats.shape_tests[type(self).__name__] += 1
+         transformed_ray = ray.transform(self.inverse_transform)
          self.saved_ray = transformed_ray
          return self.local_intersect(transformed_ray)
     
-    def set_material(self, material):
-        self._material = material
+    def intersect_ts(self, ray):
+        # Like intersect, but returns a tuple of t values and builds no
+        # Ray or Intersection objects; for queries that only need distances.
+        if _stats is not None:
+            _stats.shape_tests[type(self).__name__] += 1
+        m = self.inverse_transform.m
+        o = ray.origin
+        d = ray.direction
+        ox = m[0] * o.x + m[1] * o.y + m[2] * o.z + m[3] * o.w
+        oy = m[4] * o.x + m[5] * o.y + m[6] * o.z + m[7] * o.w
+        oz = m[8] * o.x + m[9] * o.y + m[10] * o.z + m[11] * o.w
+        dx = m[0] * d.x + m[1] * d.y + m[2] * d.z + m[3] * d.w
+        dy = m[4] * d.x + m[5] * d.y + m[6] * d.z + m[7] * d.w
+        dz = m[8] * d.x + m[9] * d.y + m[10] * d.z + m[11] * d.w
+        if _has_local_ts(type(self)):
+            return self.local_ts(ox, oy, oz, dx, dy, dz)
+        return Shape.local_ts(self, ox, oy, oz, dx, dy, dz)
+
+    def local_ts(self, ox, oy, oz, dx, dy, dz):
+        # Object-space t values; shapes override this with a direct formula.
+        ray = Ray(point(ox, oy, oz), vector(dx, dy, dz))
+        return tuple(x.t for x in self.local_intersect(ray))
+
+    def local_intersect_batch(self, origins, directions):
+        # Object-space rays as (n, 3) or (n, 4) arrays -> arrays (t0, t1) of
+        # the two nearest intersections, NaN where a ray has fewer hits. For
+        # rays with more than two hits, those behind the origin are skipped
+        # so that the visible one is never dropped.
+        kernel = batch_intersect_kernel(type(self))
+        if kernel is not None:
+            return kernel(self, origins, directions)
+        _require_numpy()
+        count = len(origins)
+        t0 = np.full(count, np.nan)
+        t1 = np.full(count, np.nan)
+        for i in range(count):
+            ox, oy, oz = origins[i][:3]
+            dx, dy, dz = directions[i][:3]
+            ray = Ray(point(ox, oy, oz), vector(dx, dy, dz))
+            ts = sorted(x.t for x in self.local_intersect(ray))
+            if len(ts) > 2:
+                ts = [t for t in ts if t >= 0]
+            if ts:
+                t0[i] = ts[0]
+            if len(ts) > 1:
+                t1[i] = ts[1]
+        return t0, t1
+
+    def local_bounds(self):
+        # Object-space BoundingBox, or None when the shape is unbounded.
+        return None
+
+    def bounds(self):
+        # World-space BoundingBox, or None when the shape is unbounded.
+        if self._bounds is None:
+            local = self.local_bounds()
+            self._bounds = False if local is None else local.transform(self._transform)
+        return self._bounds or None
 
-    def material(self):
-        return self._material
+    def set_material(self, material):
+        self.material = material
 
     def set_transform(self, t):
         self.transform = t
         
-    def normal_at(self, world_point):
-        object_point = self.transform.inverse() * world_point
-        object_normal = self.local_normal_at(object_point)
-        world_normal = self.transform.inverse().transpose() * object_normal
+    def intersection_at(self, ray, t):
+        # The Intersection for a hit at t found by intersect_ts.
+        return Intersection(t, self)
+
+    def normal_at(self, world_point, hit=None):
+        object_point = self.inverse_transform * world_point
+        if hit is None or hit.inner is None:
+            object_normal = self.local_normal_at(object_point)
+        else:
+            object_normal = self.local_normal_at(object_point, hit.inner)
+        # object_point is no longer needed, so reuse it for the result.
+        world_normal = self.inverse_transpose.transform_into(object_normal, object_point)
         world_normal.w = 0
-        return world_normal.normalize()
+        return world_normal.normalize_into()
 
 
 
 
+_local_ts_types = {}
+
+def _has_local_ts(shape_type):
+    # Whether shape_type's own local_ts is at least as specific as its
+    # local_intersect; a subclass overriding only local_intersect must not
+    # inherit its parent's closed-form local_ts.
+    result = _local_ts_types.get(shape_type)
+    if result is None:
+        result = False
+        for cls in shape_type.__mro__:
+            if cls is Shape:
+                break
+            if "local_ts" in cls.__dict__:
+                result = True
+                break
+            if "local_intersect" in cls.__dict__:
+                break
+        _local_ts_types[shape_type] = result
+    return result
+
 class Sphere (Shape):
     def __init__(self, center=Tuple(0, 0, 0, 1), radius=1,transform=identity_matrix,material =Material()):
         self.center = center
@@ -308,72 +841,143 @@ class Sphere (Shape):
         super().__init__(transform)
     
     def local_normal_at(self,local_point):
-        return local_point - Tuple(0, 0, 0, 1)   
+        return Tuple(local_point.x, local_point.y, local_point.z, local_point.w - 1)
+
+    def local_bounds(self):
+        c, r = self.center, self.radius
+        return BoundingBox(point(c.x - r, c.y - r, c.z - r), point(c.x + r, c.y + r, c.z + r))
     
     def local_intersect(self, ray):
-        sphere_to_ray = ray.origin - self.center
-        a = ray.direction.dot(ray.direction)
-        b = 2 * sphere_to_ray.dot(ray.direction)
-        c = sphere_to_ray.dot(sphere_to_ray) - self.radius * self.radius
+        o = ray.origin
+        d = ray.direction
+        return Intersections(*[Intersection(t, self) for t in self.local_ts(o.x, o.y, o.z, d.x, d.y, d.z)])
+
+    def local_ts(self, ox, oy, oz, dx, dy, dz):
+        center = self.center
+        sx = ox - center.x
+        sy = oy - center.y
+        sz = oz - center.z
+        a = dx * dx + dy * dy + dz * dz
+        b = 2 * (sx * dx + sy * dy + sz * dz)
+        c = sx * sx + sy * sy + sz * sz - self.radius * self.radius
 
         discriminant = b * b - 4 * a * c
         if discriminant < 0: 
-            return Intersections()  # No intersections
+            return ()  # No intersections
         else:
             t1 = (-b - math.sqrt(discriminant)) / (2 * a)
             t2 = (-b + math.sqrt(discriminant)) / (2 * a)
-            return Intersections(Intersection(t1, self), Intersection(t2, self))
+            return (t1, t2)
 
 
 class Intersection:
-    def __init__(self, t, object):
+    # inner is the intersection with the shape one level down when object
+    # is a Group or Instance; normal_at follows it to the shape that was hit.
+    __slots__ = ("t", "object", "inner")
+
+    def __init__(self, t, object, inner=None):
         self.t = t
         self.object = object
+        self.inner = inner
+
+_HIT_UNKNOWN = object()
+
+class Intersections(collections.abc.MutableSequence):
+    # Intersections kept in one list that is sorted by t lazily, the first
+    # time ordered access is needed. Per-shape results arrive already
+    # sorted, so after a series of extend calls the list is a sequence of
+    # sorted runs that a single sort merges in linear time. hit() needs no
+    # ordering and is cached until the collection changes.
+    __slots__ = ("_items", "_sorted", "_hit")
 
-class Intersections(collections.MutableSequence):
     def __init__(self, *intersections):
-        self.intersections = list(intersections)
+        if _stats is not None:
+            _stats.intersections_lists += 1
+        self._items = list(intersections)
+        self._sorted = _is_sorted(self._items)
+        self._hit = _HIT_UNKNOWN
+
+    def _ordered(self):
+        if not self._sorted:
+            self._items.sort(key = intersect_sort_function)
+            self._sorted = True
+        return self._items
+
+    @property
+    def intersections(self):
+        return self._ordered()
 
     def __len__(self):
-        return len(self.intersections)
+        return len(self._items)
 
     def __getitem__(self, index):
-        return self.intersections[index]
-    
+        return self._ordered()[index]
+
+    def __iter__(self):
+        return iter(self._ordered())
+
     def append(self,intersection):
-        self.intersections.append(intersection) 
+        items = self._items
+        if self._sorted and items and intersection.t < items[-1].t:
+            self._sorted = False
+        items.append(intersection)
+        self._hit = _HIT_UNKNOWN
 
-    def __delitem__(self, i): del self.intersections[i]
+    def __delitem__(self, i):
+        del self._ordered()[i]
+        self._hit = _HIT_UNKNOWN
 
     def __setitem__(self, i, v):
-        #self.check(v)
-        self.intersections[i] = v
-
+        self._ordered()[i] = v
+        self._sorted = False
+        self._hit = _HIT_UNKNOWN
 
     def extend(self,intersections):
-        self.intersections.extend(intersections)
-        self.intersections.sort(key = intersect_sort_function)
+        items = self._items
+        if isinstance(intersections, Intersections):
+            other_sorted = intersections._sorted
+            intersections = intersections._items
+        else:
+            intersections = list(intersections)
+            other_sorted = _is_sorted(intersections)
+        if not intersections:
+            return
+        if not (self._sorted and other_sorted and (not items or items[-1].t <= intersections[0].t)):
+            self._sorted = False
+        items.extend(intersections)
+        self._hit = _HIT_UNKNOWN
 
     def insert(self, i, v):
-#        self.check(v)
-        self.intersections.insert(i, v)
+        self._ordered().insert(i, v)
+        self._sorted = False
+        self._hit = _HIT_UNKNOWN
 
     def hit(self):
-        hit = None
-        for i in self.intersections:
-            if i.t >= 0 and (hit is None or i.t < hit.t):
-                hit = i
+        hit = self._hit
+        if hit is _HIT_UNKNOWN:
+            hit = None
+            for i in self._items:
+                if i.t >= 0 and (hit is None or i.t < hit.t):
+                    hit = i
+            self._hit = hit
         return hit
 
+def _is_sorted(intersections):
+    for a, b in zip(intersections, intersections[1:]):
+        if b.t < a.t:
+            return False
+    return True
 
 
 class Ray:
+    __slots__ = ("origin", "direction")
+
     def __init__(self, origin, direction):
         self.origin = origin
         self.direction = direction
 
     def position(self, t):
-        return self.origin + self.direction * t
+        return self.origin.multiply_add(self.direction, t)
     
     def transform(self, m):
         return Ray(m * self.origin, m * self.direction)
@@ -389,42 +993,340 @@ def vector(x, y, z):
 
 
 class Canvas:
-    def __init__(self, width, height):
+    # Pixels live in one flat array of red, green, blue components, row by
+    # row, instead of one Color object per pixel.
+    typecodes = {"float64": "d", "float32": "f"}
+
+    def __init__(self, width, height, dtype="float64"):
+        if dtype not in Canvas.typecodes:
+            raise ValueError(f"Unsupported canvas dtype {dtype!r}")
         self.width = width
         self.height = height
-        self.pixels = [[Color(0, 0, 0) for _ in range(width)] for _ in range(height)]
+        self.dtype = dtype
+        self.typecode = Canvas.typecodes[dtype]
+        self.data = array(self.typecode, [0.0]) * (width * height * 3)
+
+    def _offset(self, x, y):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError(f"Pixel ({x}, {y}) is outside the canvas")
+        return (y * self.width + x) * 3
 
     def write_pixel(self, x, y, color):
-        self.pixels[y][x] = color
+        i = self._offset(x, y)
+        data = self.data
+        data[i] = color.red
+        data[i + 1] = color.green
+        data[i + 2] = color.blue
 
     def pixel_at(self, x, y):
-        return self.pixels[y][x]
+        i = self._offset(x, y)
+        data = self.data
+        return Color(data[i], data[i + 1], data[i + 2])
+
+    @property
+    def pixels(self):
+        return [[self.pixel_at(x, y) for x in range(self.width)] for y in range(self.height)]
+
+    def write_row(self, y, components, x=0):
+        # Writes flat red, green, blue components starting at pixel (x, y).
+        if len(components) % 3 or x + len(components) // 3 > self.width:
+            raise ValueError("Row data does not fit the canvas")
+        i = self._offset(x, y)
+        self.data[i:i + len(components)] = array(self.typecode, components)
+
+    def write_tile(self, tile, pixels):
+        # pixels is a row-major sequence of (red, green, blue) for the tile.
+        x0, y0, x1, y1 = tile
+        width = x1 - x0
+        for y in range(y0, y1):
+            start = (y - y0) * width
+            self.write_row(y, [c for pixel in pixels[start:start + width] for c in pixel], x0)
+
+    def row(self, y):
+        # Zero-copy view of one row's components.
+        i = self._offset(0, y)
+        return self.buffer()[i:i + self.width * 3]
+
+    def buffer(self):
+        return memoryview(self.data)
+
+    def __buffer__(self, flags):
+        return memoryview(self.data)
+
+    def quantized_row(self, y):
+        return quantize(self.row(y))
+
+    def to_numpy(self):
+        # (height, width, 3) array sharing memory with the canvas.
+        _require_numpy()
+        return np.frombuffer(self.data, dtype=self.dtype).reshape(self.height, self.width, 3)
+
+
+class MappedCanvas(Canvas):
+    # A canvas whose pixels live in a memory-mapped file (an anonymous
+    # temporary file unless path is given), so only the pages being touched
+    # need to be in RAM. With dtype="uint8" the file is laid out as a binary
+    # P6 image: a PPM header followed by the quantized pixels, which makes
+    # the mapped file itself the final image once the render is flushed.
+    typecodes = dict(Canvas.typecodes, uint8="B")
+
+    def __init__(self, width, height, dtype="float64", path=None):
+        if dtype not in MappedCanvas.typecodes:
+            raise ValueError(f"Unsupported canvas dtype {dtype!r}")
+        self.width = width
+        self.height = height
+        self.dtype = dtype
+        self.path = path
+        self.typecode = MappedCanvas.typecodes[dtype]
+        header = _ppm_header("P6", width, height) if dtype == "uint8" else b""
+        size = len(header) + width * height * 3 * array(self.typecode).itemsize
+
+        self._file = open(path, "w+b") if path else tempfile.TemporaryFile()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._map[:len(header)] = header
+        self.data = memoryview(self._map)[len(header):].cast(self.typecode)
 
-def canvas_to_ppm(canvas):
-    ppm_lines = []
-    ppm_lines.append("P3")
-    ppm_lines.append(f"{canvas.width} {canvas.height}")
-    ppm_lines.append("255")
-
-    for row in canvas.pixels:
-        pixel_line = ""
-        for pixel in row:
-            red = int(max(0, min(255, pixel.red * 255)))
-            green = int(max(0, min(255, pixel.green * 255)))
-            blue = int(max(0, min(255, pixel.blue * 255)))
-            pixel_line += f"{red} {green} {blue} "
-        ppm_lines.append(pixel_line.strip())
-    
-    ppm_lines.append("")
+    def write_pixel(self, x, y, color):
+        if self.dtype != "uint8":
+            return super().write_pixel(x, y, color)
+        i = self._offset(x, y)
+        self.data[i:i + 3] = bytes(quantize((color.red, color.green, color.blue)))
 
-    return "\n".join(ppm_lines)
+    def pixel_at(self, x, y):
+        if self.dtype != "uint8":
+            return super().pixel_at(x, y)
+        i = self._offset(x, y)
+        data = self.data
+        return Color(data[i] / 255, data[i + 1] / 255, data[i + 2] / 255)
+
+    def write_row(self, y, components, x=0):
+        if self.dtype != "uint8":
+            return super().write_row(y, components, x)
+        if len(components) % 3 or x + len(components) // 3 > self.width:
+            raise ValueError("Row data does not fit the canvas")
+        i = self._offset(x, y)
+        self.data[i:i + len(components)] = bytes(quantize(components))
+
+    def quantized_row(self, y):
+        if self.dtype != "uint8":
+            return super().quantized_row(y)
+        return self.row(y)
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        # Views returned by row() or buffer() must be released first.
+        if self._map.closed:
+            return
+        self.data.release()
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+PPM_LINE_LIMIT = 70
+PPM_CHUNK_BYTES = 1 << 16
+
+def quantize(values):
+    # Colour components in [0, 1] -> ints in [0, 255], clamping out of range values.
+    if np is not None:
+        return np.clip(np.asarray(values, dtype=float) * 255, 0, 255).astype(np.uint8).tolist()
+    return [int(max(0, min(255, value * 255))) for value in values]
+
+def _ppm_header(format, width, height):
+    if format not in ("P3", "P6"):
+        raise ValueError(f"Unknown PPM format {format!r}")
+    return f"{format}\n{width} {height}\n255\n".encode("ascii")
+
+def _encode_ppm_row(values, format):
+    # One row of quantized red, green, blue values. P3 rows start on a new
+    # line and wrap so no line is longer than PPM_LINE_LIMIT characters.
+    if format == "P6":
+        return bytes(values)
+
+    lines = []
+    line = []
+    length = -1
+    for token in map(str, values):
+        if length + 1 + len(token) > PPM_LINE_LIMIT:
+            lines.append(" ".join(line))
+            line = []
+            length = -1
+        line.append(token)
+        length += 1 + len(token)
+    lines.append(" ".join(line))
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+def _canvas_rows(canvas):
+    for y in range(canvas.height):
+        yield canvas.quantized_row(y)
+
+def write_ppm(canvas, out, format="P3"):
+    # Writes canvas to the binary file object out, buffering at most about
+    # PPM_CHUNK_BYTES of encoded rows between writes.
+    trace = _trace
+    if trace is not None:
+        start = time.time_ns()
+    _write_ppm(canvas, out, format)
+    if trace is not None:
+        trace.add("encode", start, format=format, width=canvas.width, height=canvas.height)
+
+def _write_ppm(canvas, out, format):
+    out.write(_ppm_header(format, canvas.width, canvas.height))
+    if format == "P6" and canvas.dtype == "uint8":
+        # Already quantized: hand out slices of the pixel buffer directly.
+        pixels = canvas.buffer()
+        for start in range(0, len(pixels), PPM_CHUNK_BYTES):
+            out.write(pixels[start:start + PPM_CHUNK_BYTES])
+        return
+
+    chunk = []
+    size = 0
+    for row in _canvas_rows(canvas):
+        data = _encode_ppm_row(row, format)
+        chunk.append(data)
+        size += len(data)
+        if size >= PPM_CHUNK_BYTES:
+            out.write(b"".join(chunk))
+            chunk = []
+            size = 0
+    out.write(b"".join(chunk))
+
+def canvas_to_ppm(canvas):
+    ppm = [_ppm_header("P3", canvas.width, canvas.height)]
+    for row in _canvas_rows(canvas):
+        ppm.append(_encode_ppm_row(row, "P3"))
+    return b"".join(ppm).decode("ascii")
+
+def _read_ppm_header(data):
+    # Returns the four header tokens and the offset of the single
+    # whitespace byte that ends the header, skipping # comments.
+    tokens = []
+    position = 0
+    while len(tokens) < 4:
+        while data[position:position + 1].isspace():
+            position += 1
+        if data[position:position + 1] == b"#":
+            position = data.find(b"\n", position)
+            if position < 0:
+                raise ValueError("Truncated PPM header")
+            continue
+        start = position
+        while position < len(data) and not data[position:position + 1].isspace():
+            position += 1
+        if start == position:
+            raise ValueError("Truncated PPM header")
+        tokens.append(data[start:position])
+    return tokens, position
+
+def read_ppm(file):
+    # Reads a P3 or P6 image from a binary file object into a Canvas.
+    data = file.read()
+    tokens, position = _read_ppm_header(data)
+    format = tokens[0].decode("ascii")
+    width, height, maxval = (int(token) for token in tokens[1:])
+    if not 0 < maxval < 65536:
+        raise ValueError(f"Invalid PPM maxval {maxval}")
+    if format == "P6" and maxval > 255:
+        # Two bytes per sample, most significant first.
+        raw = data[position + 1:position + 1 + width * height * 6]
+        values = [raw[i] << 8 | raw[i + 1] for i in range(0, len(raw) - 1, 2)]
+    elif format == "P6":
+        values = data[position + 1:position + 1 + width * height * 3]
+    elif format == "P3":
+        values = [int(token) for token in data[position:].split()]
+    else:
+        raise ValueError(f"Unknown PPM format {format!r}")
+    if len(values) < width * height * 3:
+        raise ValueError("Truncated PPM pixel data")
+
+    canvas = Canvas(width, height)
+    row_length = width * 3
+    for y in range(height):
+        canvas.write_row(y, [value / maxval for value in values[y * row_length:(y + 1) * row_length]])
+    return canvas
+
+def stream_ppm(tiles, width, height, out, background=False, format="P3"):
+    # Writes (tile, pixels) pairs, e.g. from render_iter, to the binary file
+    # object out. Rows are written in order as soon as they are complete,
+    # so only rows still waiting for tiles are held in memory and the file
+    # always holds a valid prefix of the image. With background=True a
+    # separate thread encodes and writes the rows while the caller keeps
+    # tracing.
+    out.write(_ppm_header(format, width, height))
+    trace = _trace
+
+    def encode(row):
+        if trace is not None:
+            start = time.time_ns()
+        data = _encode_ppm_row(quantize([component for pixel in row for component in pixel]), format)
+        if trace is not None:
+            trace.add("encode row", start)
+        return data
+
+    if background:
+        rows = queue.Queue(maxsize=64)
+        failure = []
+
+        def writer():
+            while True:
+                row = rows.get()
+                if row is None:
+                    return
+                if not failure:
+                    try:
+                        out.write(encode(row))
+                        out.flush()
+                    except Exception as e:
+                        failure.append(e)
+
+        thread = threading.Thread(target=writer, daemon=True)
+        thread.start()
+        emit = rows.put
+    else:
+        def emit(row):
+            out.write(encode(row))
+            out.flush()
+
+    pending = {}
+    filled = {}
+    next_row = 0
+    try:
+        for (x0, y0, x1, y1), pixels in tiles:
+            i = 0
+            for y in range(y0, y1):
+                if y not in pending:
+                    pending[y] = [None] * width
+                    filled[y] = 0
+                pending[y][x0:x1] = pixels[i:i + x1 - x0]
+                filled[y] += x1 - x0
+                i += x1 - x0
+            while filled.get(next_row) == width:
+                emit(pending.pop(next_row))
+                del filled[next_row]
+                next_row += 1
+    finally:
+        if background:
+            rows.put(None)
+            thread.join()
+    if background and failure:
+        raise failure[0]
+    if next_row != height:
+        raise ValueError(f"Incomplete image: only {next_row} of {height} rows were rendered")
 
 def intersect(shape, ray):
     #transformed_ray = ray.transform(sphere.transform.inverse())
     return shape.intersect(ray)
 
-def normal_at(sphere:Sphere, world_point):
-    return sphere.normal_at(world_point)
+def normal_at(sphere:Sphere, world_point, hit=None):
+    return sphere.normal_at(world_point, hit)
 #    object_point = sphere.transform.inverse() * world_point
 #    object_normal = object_point - Tuple(0, 0, 0, 1)
 #    world_normal = sphere.transform.inverse().transpose() * object_normal
@@ -434,39 +1336,495 @@ def normal_at(sphere:Sphere, world_point):
 def reflect(v, n):
     return v - n * 2 * v.dot(n)
 
-def lighting(material: Material, light, point, eyev, normalv,in_shadow=False):
-
+def lighting(material: Material, light, point, eyev, normalv,in_shadow=False, object=None):
+    # Same arithmetic as the Tuple/Color formulation, in the same order,
+    # but on plain floats so only the returned Color is allocated. Patterns
+    # are evaluated in the space of object when one is given.
+    if _stats is not None:
+        _stats.lighting_calls += 1
     if material.pattern:
-        color = material.pattern.pattern_at(point)
+        color = material.pattern.pattern_at_object(object, point)
     else:
         color = material.color
 
-    effective_color = light.intensity * color
-    
-    # Ambient lighting
-    ambient = effective_color * material.ambient
+    intensity = light.intensity
+    red = intensity.red * color.red
+    green = intensity.green * color.green
+    blue = intensity.blue * color.blue
 
-    if not in_shadow:
-    # Diffuse lighting
-        light_v = (light.position - point).normalize()
-        light_dot_normal = light_v.dot(normalv)
-        diffuse = effective_color * material.diffuse * max(light_dot_normal, 0)
+    # Ambient lighting
+    ambient = material.ambient
 
-        # Specular lighting
-        reflect_v = reflect(-light_v, normalv)
-        reflect_dot_eye = reflect_v.dot(eyev)
-        specular = effective_color * material.specular * pow(max(reflect_dot_eye, 0), material.shininess)
+    if in_shadow:
+        return Color(red * ambient, green * ambient, blue * ambient)
 
-        return ambient + diffuse + specular
-    else:
-        return ambient
+    # Diffuse lighting
+    position = light.position
+    lx = position.x - point.x
+    ly = position.y - point.y
+    lz = position.z - point.z
+    lw = position.w - point.w
+    magnitude = math.sqrt(lx * lx + ly * ly + lz * lz + lw * lw)
+    lx, ly, lz = lx / magnitude, ly / magnitude, lz / magnitude
+    nx, ny, nz = normalv.x, normalv.y, normalv.z
+    diffuse = max(lx * nx + ly * ny + lz * nz, 0)
+
+    # Specular lighting: reflect(-light_v, normalv) . eyev
+    d = -lx * nx + -ly * ny + -lz * nz
+    reflect_dot_eye = ((-lx - nx * 2 * d) * eyev.x + (-ly - ny * 2 * d) * eyev.y
+                       + (-lz - nz * 2 * d) * eyev.z)
+    specular = pow(max(reflect_dot_eye, 0), material.shininess)
+
+    kd = material.diffuse
+    ks = material.specular
+    return Color(red * ambient + red * kd * diffuse + red * ks * specular,
+                 green * ambient + green * kd * diffuse + green * ks * specular,
+                 blue * ambient + blue * kd * diffuse + blue * ks * specular)
+
+BVH_MIN_OBJECTS = 8
+BVH_LEAF_SIZE = 2
+BVH_BINS = 12
+BVH_PADDING = 1e-6
+
+def _box_area(box):
+    dx, dy, dz = box[3] - box[0], box[4] - box[1], box[5] - box[2]
+    return 2 * (dx * dy + dy * dz + dz * dx)
+
+def _box_union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]),
+            max(a[3], b[3]), max(a[4], b[4]), max(a[5], b[5]))
+
+def _box_range(box, origin, direction):
+    # Parametric interval (tmin, tmax) over which the ray's line is inside
+    # box; tmin > tmax means the line misses it.
+    tmin, tmax = -math.inf, math.inf
+    for axis, o, d in ((0, origin.x, direction.x), (1, origin.y, direction.y), (2, origin.z, direction.z)):
+        lo, hi = box[axis], box[axis + 3]
+        if d == 0:
+            if o < lo or o > hi:
+                return math.inf, -math.inf
+            continue
+        t0 = (lo - o) / d
+        t1 = (hi - o) / d
+        if t0 > t1:
+            t0, t1 = t1, t0
+        if t0 > tmin:
+            tmin = t0
+        if t1 < tmax:
+            tmax = t1
+    return tmin, tmax
+
+class BVHNode:
+    def __init__(self, box, left=None, right=None, indices=None):
+        self.box = box
+        self.left = left
+        self.right = right
+        self.indices = indices
+
+class BVH:
+    # Bounding volume hierarchy over a list of shapes, split with a binned
+    # surface area heuristic. Unbounded shapes (planes) are kept aside and
+    # tested by every query. Queries return object indices in list order so
+    # callers see exactly the brute-force ordering.
+    def __init__(self, objects):
+        self.objects = list(objects)
+        self.unbounded = []
+        self.root = None
+        self.refit()
+
+    def _object_boxes(self):
+        boxes = []
+        for shape in self.objects:
+            bounds = shape.bounds()
+            if bounds is None:
+                boxes.append(None)
+            else:
+                lo, hi = bounds.minimum, bounds.maximum
+                boxes.append((lo.x - BVH_PADDING, lo.y - BVH_PADDING, lo.z - BVH_PADDING,
+                              hi.x + BVH_PADDING, hi.y + BVH_PADDING, hi.z + BVH_PADDING))
+        return boxes
+
+    def rebuild(self):
+        boxes = self._object_boxes()
+        self.boxes = boxes
+        self.unbounded = [i for i, box in enumerate(boxes) if box is None]
+        bounded = [i for i, box in enumerate(boxes) if box is not None]
+        self.root = self._build(bounded) if len(self.objects) >= BVH_MIN_OBJECTS and bounded else None
+
+    def refit(self):
+        # Keeps the tree shape and only recomputes boxes when every object
+        # is still bounded the same way; otherwise rebuilds from scratch.
+        boxes = self._object_boxes()
+        if self.root is None or [b is None for b in boxes] != [b is None for b in self.boxes]:
+            return self.rebuild()
+        self.boxes = boxes
+        self._refit(self.root)
+
+    def _refit(self, node):
+        if node.indices is not None:
+            box = self.boxes[node.indices[0]]
+            for i in node.indices[1:]:
+                box = _box_union(box, self.boxes[i])
+        else:
+            box = _box_union(self._refit(node.left), self._refit(node.right))
+        node.box = box
+        return box
+
+    def _build(self, indices):
+        boxes = self.boxes
+        box = boxes[indices[0]]
+        for i in indices[1:]:
+            box = _box_union(box, boxes[i])
+        if len(indices) <= BVH_LEAF_SIZE:
+            return BVHNode(box, indices=indices)
+
+        centroids = {i: ((boxes[i][0] + boxes[i][3]) / 2, (boxes[i][1] + boxes[i][4]) / 2,
+                         (boxes[i][2] + boxes[i][5]) / 2) for i in indices}
+        best_cost, best_axis, best_split, best_lo, best_scale = math.inf, None, None, 0, 0
+        for axis in range(3):
+            lo = min(c[axis] for c in centroids.values())
+            hi = max(c[axis] for c in centroids.values())
+            if hi <= lo:
+                continue
+            scale = BVH_BINS / (hi - lo)
+            counts = [0] * BVH_BINS
+            bin_boxes = [None] * BVH_BINS
+            for i in indices:
+                b = min(int((centroids[i][axis] - lo) * scale), BVH_BINS - 1)
+                counts[b] += 1
+                bin_boxes[b] = boxes[i] if bin_boxes[b] is None else _box_union(bin_boxes[b], boxes[i])
+
+            # Sweep from the right to collect suffix areas, then from the
+            # left to evaluate count * area on both sides of every split.
+            right_area = [0] * BVH_BINS
+            right_count = [0] * BVH_BINS
+            acc, n = None, 0
+            for b in range(BVH_BINS - 1, 0, -1):
+                if bin_boxes[b] is not None:
+                    acc = bin_boxes[b] if acc is None else _box_union(acc, bin_boxes[b])
+                n += counts[b]
+                right_area[b] = _box_area(acc) if acc is not None else 0
+                right_count[b] = n
+            acc, n = None, 0
+            for split in range(1, BVH_BINS):
+                if bin_boxes[split - 1] is not None:
+                    acc = bin_boxes[split - 1] if acc is None else _box_union(acc, bin_boxes[split - 1])
+                n += counts[split - 1]
+                if n == 0 or right_count[split] == 0:
+                    continue
+                cost = n * _box_area(acc) + right_count[split] * right_area[split]
+                if cost < best_cost:
+                    best_cost, best_axis, best_split, best_lo, best_scale = cost, axis, split, lo, scale
+
+        if best_axis is None:
+            return BVHNode(box, indices=indices)
+        left = [i for i in indices if min(int((centroids[i][best_axis] - best_lo) * best_scale), BVH_BINS - 1) < best_split]
+        right = [i for i in indices if min(int((centroids[i][best_axis] - best_lo) * best_scale), BVH_BINS - 1) >= best_split]
+        return BVHNode(box, self._build(left), self._build(right))
+
+    def traverse(self, ray, t_min=-math.inf, t_max=math.inf):
+        # Yields the objects whose boxes overlap the ray between t_min and
+        # t_max, unbounded objects first, in no particular order.
+        if self.root is None:
+            yield from self.objects
+            return
+        objects = self.objects
+        for i in self.unbounded:
+            yield objects[i]
+        origin, direction = ray.origin, ray.direction
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            tmin, tmax = _box_range(node.box, origin, direction)
+            if tmin > tmax or tmax < t_min or tmin > t_max:
+                continue
+            if node.indices is not None:
+                for i in node.indices:
+                    yield objects[i]
+            else:
+                stack.append(node.left)
+                stack.append(node.right)
+
+    def closest(self, ray, t_min=0, t_max=math.inf):
+        # (t, index) of the nearest hit with t_min <= t <= t_max, or None.
+        # Equal t values resolve to the lower index, as in a sorted
+        # brute-force intersection list.
+        objects = self.objects
+        best_t = t_max
+        best_index = None
+
+        def consider(i):
+            nonlocal best_t, best_index
+            for t in objects[i].intersect_ts(ray):
+                if t_min <= t and (t < best_t or (t == best_t and (best_index is None or i < best_index))):
+                    best_t = t
+                    best_index = i
+
+        if self.root is None:
+            for i in range(len(objects)):
+                consider(i)
+        else:
+            for i in self.unbounded:
+                consider(i)
+            origin, direction = ray.origin, ray.direction
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                tmin, tmax = _box_range(node.box, origin, direction)
+                if tmin > tmax or tmax < t_min or tmin > best_t:
+                    continue
+                if node.indices is not None:
+                    for i in node.indices:
+                        consider(i)
+                else:
+                    # Visit the nearer child first so it can tighten best_t.
+                    left = _box_range(node.left.box, origin, direction)[0]
+                    right = _box_range(node.right.box, origin, direction)[0]
+                    if left <= right:
+                        stack.append(node.right)
+                        stack.append(node.left)
+                    else:
+                        stack.append(node.left)
+                        stack.append(node.right)
+        if best_index is None:
+            return None
+        return best_t, best_index
+
+    def candidates(self, ray):
+        # Sorted indices of every object whose box the ray's line crosses.
+        if self.root is None:
+            return range(len(self.objects))
+        origin, direction = ray.origin, ray.direction
+        found = list(self.unbounded)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            tmin, tmax = _box_range(node.box, origin, direction)
+            if tmin > tmax:
+                continue
+            if node.indices is not None:
+                found.extend(node.indices)
+            else:
+                stack.append(node.left)
+                stack.append(node.right)
+        found.sort()
+        return found
+
+# Flattened, read-only view of a World for the batch renderer. Shapes are
+# grouped by type; within a group row i describes shapes[i], which is
+# world.objects[indices[i]] or, for an Instance, the shape it places, and
+# holds its 4x4 inverse transform (for an Instance the composed
+# world-to-prototype one) and inverse transpose (16 doubles each, row-major)
+# and its material as the MATERIAL_FIELDS doubles. pattern_ids refer into CompiledScene.patterns,
+# -1 meaning a plain color. group_ids and rows map a world index back to
+# its group and row.
+#
+# Only object-space geometry of the shapes is used, so spheres and planes
+# are pickled as a few doubles each and rebuilt untransformed, and the
+# inverse transposes are recomputed on load, which keeps sending the scene
+# to worker processes cheap.
+class CompiledShapes(collections.namedtuple(
+        "CompiledShapes",
+        ["shape_type", "indices", "shapes", "inverse_transforms", "inverse_transposes", "materials",
+         "pattern_ids"])):
+    __slots__ = ()
+
+    def __reduce__(self):
+        geometry = _compact_geometry(self.shape_type, self.shapes)
+        fields = self._replace(shapes=self.shapes if geometry is None else None, inverse_transposes=None)
+        return _restore_compiled_shapes, (tuple(fields), geometry)
+
+def _compact_geometry(shape_type, shapes):
+    # Doubles that _object_space_shapes rebuilds shapes from, or None for
+    # types that have to be pickled whole.
+    if shape_type is Sphere:
+        geometry = array("d")
+        for shape in shapes:
+            c = shape.center
+            geometry.extend((c.x, c.y, c.z, shape.radius))
+        return geometry
+    if shape_type is Plane:
+        return array("d")
+    return None
+
+def _object_space_shapes(shape_type, count, geometry):
+    if shape_type is Sphere:
+        return tuple(Sphere(center=point(geometry[i], geometry[i + 1], geometry[i + 2]), radius=geometry[i + 3])
+                     for i in range(0, len(geometry), 4))
+    return tuple(Plane() for _ in range(count))
+
+def _restore_compiled_shapes(fields, geometry):
+    group = CompiledShapes(*fields)
+    inverses = group.inverse_transforms
+    transposes = array("d", (inverses[start + col * 4 + row] for start in range(0, len(inverses), 16)
+                             for row in range(4) for col in range(4)))
+    shapes = group.shapes
+    if geometry is not None:
+        shapes = _object_space_shapes(group.shape_type, len(group.indices), geometry)
+    return group._replace(shapes=shapes, inverse_transposes=transposes)
+
+CompiledScene = collections.namedtuple(
+    "CompiledScene", ["groups", "group_ids", "rows", "patterns", "light_position", "light_intensity"])
+
+MATERIAL_FIELDS = ("red", "green", "blue", "ambient", "diffuse", "specular", "shininess")
+
+def compile_scene(objects, light):
+    # Group hits need the scalar chain of inner intersections for their
+    # normals and materials, which the batch renderer does not track.
+    for shape in objects:
+        while isinstance(shape, Instance):
+            shape = shape.prototype
+        if isinstance(shape, Group):
+            raise ValueError("The numpy engine cannot render Groups; use engine='python'")
+    members = {}
+    numbers = {}
+    group_ids = array("l")
+    rows = array("l")
+    leaves = []
+    for index, shape in enumerate(objects):
+        inverse = Matrix4.from_matrix(shape.inverse_transform)
+        while isinstance(shape, Instance):
+            shape = shape.prototype
+            inverse = Matrix4.from_matrix(shape.inverse_transform) * inverse
+        leaves.append((shape, inverse))
+        shape_type = type(shape)
+        if shape_type not in members:
+            numbers[shape_type] = len(members)
+            members[shape_type] = []
+        indices = members[shape_type]
+        group_ids.append(numbers[shape_type])
+        rows.append(len(indices))
+        indices.append(index)
+
+    groups = []
+    patterns = []
+    pattern_ids = {}
+    for shape_type, indices in members.items():
+        shapes = tuple(leaves[index][0] for index in indices)
+        inverses = array("d")
+        inverse_transposes = array("d")
+        materials = array("d")
+        shape_patterns = array("l")
+        for index in indices:
+            inverse = leaves[index][1]
+            inverses.extend(inverse.m)
+            inverse_transposes.extend(inverse.transpose().m)
+            # An Instance's material is its override or its prototype's.
+            material = objects[index].material
+            color = material.color
+            materials.extend((color.red, color.green, color.blue, material.ambient,
+                              material.diffuse, material.specular, material.shininess))
+            pattern = material.pattern
+            if pattern:
+                if id(pattern) not in pattern_ids:
+                    pattern_ids[id(pattern)] = len(patterns)
+                    patterns.append(pattern)
+                shape_patterns.append(pattern_ids[id(pattern)])
+            else:
+                shape_patterns.append(-1)
+        groups.append(CompiledShapes(shape_type, array("l", indices), shapes, inverses,
+                                     inverse_transposes, materials, shape_patterns))
+
+    light_position = light_intensity = None
+    if light is not None:
+        p, i = light.position, light.intensity
+        light_position = array("d", (p.x, p.y, p.z, p.w))
+        light_intensity = array("d", (i.red, i.green, i.blue))
+    return CompiledScene(tuple(groups), group_ids, rows, tuple(patterns), light_position, light_intensity)
 
 class World:
-    def __init__(self, objects=[], light=None):
-        self.objects = objects
+    def __init__(self, objects=None, light=None):
+        self.objects = objects if objects is not None else []
         self.light = light
+
+    @property
+    def objects(self):
+        return self._objects
+
+    @objects.setter
+    def objects(self, objects):
+        self._objects = objects
+        self._bvh = None
+        self._compiled = None
+        self._last_occluder = None
+
     def add_object(self,object):
         self.objects.append(object)
+        self._bvh = None
+        self._compiled = None
+
+    def bvh(self):
+        # Rebuilt when objects are added or replaced, refit when only shape
+        # transforms changed since it was built. Replacing an element of
+        # world.objects in place is not detected; assign a new list instead.
+        objects = self._objects
+        bvh = self._bvh
+        if bvh is not None and self._bvh_generation != Shape.generation:
+            if any(a is not b for a, b in zip(bvh.objects, objects)):
+                bvh = None
+            else:
+                bvh.refit()
+                self._bvh_generation = Shape.generation
+        if bvh is None or len(bvh.objects) != len(objects):
+            # The remembered occluder may be gone from the new object list.
+            bvh = self._bvh = BVH(objects)
+            self._bvh_generation = Shape.generation
+            self._last_occluder = None
+        return bvh
+
+    def compile(self, refresh=False):
+        # Cached CompiledScene, rebuilt when objects are added, removed or
+        # replaced, after a new light or any shape transform change, and
+        # always with refresh=True. Material edits are only picked up by a
+        # refresh, which render does once per call.
+        compiled = self._compiled
+        objects = self._objects
+        if (refresh or compiled is None or self._compiled_generation != Shape.generation
+                or self._compiled_light is not self.light
+                or len(self._compiled_objects) != len(objects)
+                or any(a is not b for a, b in zip(self._compiled_objects, objects))):
+            compiled = self._compiled = compile_scene(objects, self.light)
+            self._compiled_generation = Shape.generation
+            self._compiled_light = self.light
+            self._compiled_objects = list(objects)
+        return compiled
+
+    def closest_hit(self, ray, t_min=0, t_max=math.inf):
+        # The nearest Intersection with t_min <= t <= t_max, or None; the
+        # same hit as intersect_world(world, ray).hit() for the default
+        # interval, without building the sorted list of every intersection.
+        found = self.bvh().closest(ray, t_min, t_max)
+        if found is None:
+            return None
+        t, index = found
+        return self._objects[index].intersection_at(ray, t)
+
+    def is_occluded(self, origin, direction, max_distance):
+        # True when any object is hit at 0 <= t < max_distance. Returns on
+        # the first such hit, trying the object that blocked the previous
+        # query first since neighbouring shadow rays tend to share occluders.
+        ray = Ray(origin, direction)
+        bvh = self.bvh()
+        last = self._last_occluder
+        if last is not None:
+            for t in last.intersect_ts(ray):
+                if 0 <= t < max_distance:
+                    return True
+        for shape in bvh.traverse(ray, 0, max_distance):
+            if shape is last:
+                continue
+            for t in shape.intersect_ts(ray):
+                if 0 <= t < max_distance:
+                    self._last_occluder = shape
+                    return True
+        return False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_bvh"] = None
+        state["_compiled"] = None
+        state.pop("_compiled_objects", None)
+        return state
 
 def default_world():
     light = PointLight(Tuple(-10, 10, -10, 1), Color(1, 1, 1))
@@ -481,56 +1839,103 @@ def default_world():
     return World([s1, s2], light)
 
 def intersect_world(world, ray):
+    stats = _stats
+    if stats is not None:
+        start = time.perf_counter()
     xs = Intersections()
-    for obj in world.objects:
-        intersections = intersect(obj,ray)
+    objects = world.objects
+    for index in world.bvh().candidates(ray):
+        intersections = intersect(objects[index],ray)
         xs.extend(intersections)
+    if stats is not None:
+        stats.timings["intersect"] += time.perf_counter() - start
     return xs
 
 
 
 
 class Computations:
-    def __init__(self, t, object, point, eyev, normalv):
+    # surface is what gets shaded: object itself, or for a hit inside a
+    # Group or Instance a _NestedSurface for the shape that was hit.
+    __slots__ = ("t", "object", "point", "eyev", "normalv", "over_point", "surface")
+
+    def __init__(self, t, object, point, eyev, normalv, surface=None):
         self.t = t
         self.object = object
         self.point = point
         self.eyev = eyev
         self.normalv = normalv
         self.over_point=0
+        self.surface = object if surface is None else surface
+
+class _NestedSurface:
+    # Stands in for the innermost shape of a nested hit in lighting: its
+    # material, unless an Instance on the way down overrides it, and the
+    # world-to-object transform that its patterns are evaluated in.
+    __slots__ = ("material", "inverse_transform")
+
+    def __init__(self, material, inverse_transform):
+        self.material = material
+        self.inverse_transform = inverse_transform
+
+def _nested_surface(intersection):
+    override = None
+    inverse = None
+    while intersection is not None:
+        shape = intersection.object
+        inverse = shape.inverse_transform if inverse is None else shape.inverse_transform * inverse
+        if override is None and isinstance(shape, Instance):
+            override = shape._material
+        intersection = intersection.inner
+    return _NestedSurface(shape.material if override is None else override, inverse)
 
 def prepare_computations(intersection, ray):
     t = intersection.t
     object = intersection.object
     point = ray.position(t)
     eyev = -ray.direction
-    normalv = normal_at(object, point)
+    normalv = normal_at(object, point, intersection)
     inside = False
     if normalv.dot(eyev) < 0:
         inside = True
-        normalv = -normalv
+        normalv.x, normalv.y, normalv.z, normalv.w = -normalv.x, -normalv.y, -normalv.z, -normalv.w
 
-    return Computations(t, object, point, eyev, normalv)
+    surface = None if intersection.inner is None else _nested_surface(intersection)
+    return Computations(t, object, point, eyev, normalv, surface)
 
 def shade_hit(world: World, comps: Computations):
     
     #color = world.ambient_light * comps.surface_color
-    comps.over_point = comps.point + comps.normalv * 0.001
+    comps.over_point = comps.point.multiply_add(comps.normalv, 0.001)
     shadowed = is_shadowed(world, comps.over_point)
-    color = lighting(comps.object.material, world.light, comps.over_point, comps.eyev, comps.normalv,shadowed)
+    color = lighting(comps.surface.material, world.light, comps.over_point, comps.eyev, comps.normalv,shadowed,
+                     comps.surface)
     
     return color
 #    return lighting(comps.object.material, world.light, comps.point, comps.eyev, comps.normalv)
 
 def color_at(world, ray):
-    xs = intersect_world(world,ray)
-    hit = xs.hit()
+    stats = _stats
+    if stats is not None:
+        return _color_at_timed(world, ray, stats)
+    hit = world.closest_hit(ray)
     if hit:
         comps = prepare_computations(hit, ray)
         return shade_hit(world, comps)
     else:
         return Color(0, 0, 0)
 
+def _color_at_timed(world, ray, stats):
+    start = time.perf_counter()
+    hit = world.closest_hit(ray)
+    found = time.perf_counter()
+    stats.timings["intersect"] += found - start
+    if not hit:
+        return Color(0, 0, 0)
+    color = shade_hit(world, prepare_computations(hit, ray))
+    stats.timings["shade"] += time.perf_counter() - found
+    return color
+
 def intersect_sort_function(intersection):
   return intersection.t
 
@@ -540,10 +1945,10 @@ def view_transform(from_point, to_point, up_vector):
     left = forward.cross(upn)
     true_up = left.cross(forward)
 
-    orientation = Matrix(4,4,[[left.x, left.y, left.z, 0],
-                          [true_up.x, true_up.y, true_up.z, 0],
-                          [-forward.x, -forward.y, -forward.z, 0],
-                          [0, 0, 0, 1]])
+    orientation = Matrix4.from_rows([[left.x, left.y, left.z, 0],
+                                     [true_up.x, true_up.y, true_up.z, 0],
+                                     [-forward.x, -forward.y, -forward.z, 0],
+                                     [0, 0, 0, 1]])
     translation = Matrix.translation(-from_point.x, -from_point.y, -from_point.z)
 
     return orientation * translation
@@ -566,40 +1971,476 @@ class Camera:
 
         self.pixel_size = self.half_width * 2 / self.hsize
 
+    @property
+    def transform(self):
+        return self._transform
+
+    @transform.setter
+    def transform(self, t):
+        # Like Shape, the inverse and the eye position derived from it are
+        # computed once per transform instead of once per ray.
+        self._transform = t
+        self._inverse = None
+        self._origin = None
+
+    @property
+    def inverse_transform(self):
+        if self._inverse is None:
+            self._inverse = Matrix4.from_matrix(self._transform.inverse())
+        return self._inverse
+
+    @property
+    def origin(self):
+        if self._origin is None:
+            self._origin = self.inverse_transform * Tuple(0, 0, 0, 1)
+        return self._origin
+
 def almost_equal(val1,val2):
     return abs(val1 -val2) <0.001
 
-def ray_for_pixel(camera:Camera , px, py):
-    xoffset = (px + 0.5) * camera.pixel_size
-    yoffset = (py + 0.5) * camera.pixel_size
-
-    world_x = camera.half_width - xoffset
-    world_y = camera.half_height - yoffset 
-    pixel_position = camera.transform.inverse() * Tuple(world_x, world_y, -1, 1)
-    origin = camera.transform.inverse() * Tuple(0, 0, 0, 1)
-    direction = (pixel_position - origin).normalize()
+# The unnormalized direction to a pixel is
+#     inverse * (world_x, world_y, -1, 1) - origin
+# which ray_for_pixel, tile_rays and primary_rays_numpy all evaluate as a
+# column term plus a row term, in the same order, so that the three give
+# bit-identical rays. The generators compute each term once per column or
+# row and are left with three additions and a normalize per pixel.
+
+def _camera_column(camera, m, px):
+    world_x = camera.half_width - (px + 0.5) * camera.pixel_size
+    return m[0] * world_x, m[4] * world_x, m[8] * world_x, m[12] * world_x
+
+def _camera_row(camera, m, origin, py):
+    world_y = camera.half_height - (py + 0.5) * camera.pixel_size
+    return (m[1] * world_y - m[2] + m[3] - origin.x,
+            m[5] * world_y - m[6] + m[7] - origin.y,
+            m[9] * world_y - m[10] + m[11] - origin.z,
+            m[13] * world_y - m[14] + m[15] - origin.w)
+
+def _camera_ray(origin, x, y, z, w):
+    magnitude = math.sqrt(x * x + y * y + z * z + w * w)
+    return Ray(Tuple(origin.x, origin.y, origin.z, origin.w),
+               Tuple(x / magnitude, y / magnitude, z / magnitude, w))
 
-    return Ray(origin, direction)
-
-def render(camera, world):
-    image = Canvas(camera.hsize, camera.vsize)
+def ray_for_pixel(camera:Camera , px, py):
+    m = camera.inverse_transform.m
+    origin = camera.origin
+    cx, cy, cz, cw = _camera_column(camera, m, px)
+    rx, ry, rz, rw = _camera_row(camera, m, origin, py)
+    return _camera_ray(origin, cx + rx, cy + ry, cz + rz, cw + rw)
+
+def tile_rays(camera, x0, y0, x1, y1):
+    # Yields the rays of the pixels x0 <= x < x1, y0 <= y < y1 in row-major
+    # order; each equals ray_for_pixel(camera, x, y).
+    m = camera.inverse_transform.m
+    origin = camera.origin
+    columns = [_camera_column(camera, m, x) for x in range(x0, x1)]
+    for y in range(y0, y1):
+        rx, ry, rz, rw = _camera_row(camera, m, origin, y)
+        for cx, cy, cz, cw in columns:
+            yield _camera_ray(origin, cx + rx, cy + ry, cz + rz, cw + rw)
+
+def row_rays(camera, py):
+    return tile_rays(camera, 0, py, camera.hsize, py + 1)
+
+def render(camera, world, engine="python", workers=1, tile_size=32, tile_order="scanline", canvas=None,
+           progress=None):
+    # Pass canvas (e.g. a MappedCanvas) to render into existing storage.
+    image = canvas if canvas is not None else Canvas(camera.hsize, camera.vsize)
+    if (image.width, image.height) != (camera.hsize, camera.vsize):
+        raise ValueError("Canvas size does not match the camera")
+    stats = _stats
+    if stats is not None:
+        start = time.perf_counter()
+    for tile, pixels in render_iter(camera, world, engine, workers, tile_size, tile_order, progress):
+        write_tile(image, tile, pixels)
+    if stats is not None:
+        stats.timings["render"] += time.perf_counter() - start
+    return image
 
-    for y in range(camera.vsize):
-        for x in range(camera.hsize):
-            ray = ray_for_pixel(camera, x, y)
+def render_iter(camera, world, engine="python", workers=1, tile_size=32, tile_order="scanline", progress=None):
+    # Yields (tile, pixels) for every tile as soon as it is finished; with
+    # several workers the tiles arrive in completion order. progress, if
+    # given, is called as progress(done, total, rays_per_second) after each
+    # tile. The rate counts primary rays, plus shadow rays while a
+    # RenderStats is collecting.
+    if engine not in ("python", "numpy"):
+        raise ValueError(f"Unknown render engine {engine!r}")
+
+    tiles = canvas_tiles(camera.hsize, camera.vsize, tile_size, tile_order)
+    stats = _stats
+    trace = _trace
+    if progress is not None:
+        tracker = _ProgressTracker(progress, len(tiles), stats)
+
+    # Scene setup: the numpy engine needs the compiled scene, the serial
+    # Python engine the BVH. Parallel Python workers build their own.
+    if trace is not None:
+        start = time.time_ns()
+    if engine == "numpy":
+        scene = world.compile(refresh=True)
+    else:
+        scene = world
+        if workers <= 1:
+            world.bvh()
+    if trace is not None:
+        trace.add("scene setup", start, engine=engine, objects=len(world.objects))
+
+    if workers <= 1:
+        for tile in tiles:
+            pixels = render_tile(camera, scene, tile, engine)
+            if progress is not None:
+                tracker.tile_done(len(pixels))
+            yield tile, pixels
+        return
+
+    # Each worker receives the scene once through the pool initializer and
+    # then pulls tiles from the shared queue as it finishes the previous
+    # one, so slow regions do not hold up a fixed partition. Pixels do not
+    # depend on which process traced them, so the result matches the
+    # serial path exactly.
+    # The numpy engine only needs the compiled scene, so that is what gets
+    # pickled for it. At most two tiles per worker are in flight and each
+    # finished tile is dropped once yielded, so memory stays proportional
+    # to the tile size rather than the frame.
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker,
+                             initargs=(camera, scene, engine, stats is not None, trace is not None)) as pool:
+        pending = iter(tiles)
+        running = set()
+        for tile in pending:
+            running.add(pool.submit(_render_tile_in_worker, tile))
+            if len(running) >= 2 * workers:
+                break
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                tile, pixels, tile_stats, events = future.result()
+                if tile_stats is not None:
+                    stats.merge(tile_stats)
+                if events is not None:
+                    trace.events.extend(events)
+                if progress is not None:
+                    tracker.tile_done(len(pixels))
+                next_tile = next(pending, None)
+                if next_tile is not None:
+                    running.add(pool.submit(_render_tile_in_worker, next_tile))
+                yield tile, pixels
+
+def render_tile(camera, world, tile, engine="python"):
+    # Returns the tile's pixels as a row-major list of (red, green, blue).
+    # The numpy engine also accepts a CompiledScene in place of the world.
+    x0, y0, x1, y1 = tile
+    stats = _stats
+    trace = _trace
+    if stats is not None:
+        stats.primary_rays += (x1 - x0) * (y1 - y0)
+        start = time.perf_counter()
+    if trace is not None:
+        trace_start = time.time_ns()
+    if engine == "numpy":
+        region = render_region_numpy(camera, world, x0, y0, x1, y1)
+        pixels = [tuple(pixel) for pixel in region.reshape(-1, 3).tolist()]
+    else:
+        pixels = []
+        for ray in tile_rays(camera, x0, y0, x1, y1):
             color = color_at(world, ray)
-            image.write_pixel(x, y, color)
-
-    return image
+            pixels.append((color.red, color.green, color.blue))
+    if stats is not None:
+        stats.timings["tile"] += time.perf_counter() - start
+    if trace is not None:
+        trace.add("tile", trace_start, x0=x0, y0=y0, x1=x1, y1=y1, engine=engine)
+    return pixels
+
+def write_tile(canvas, tile, pixels):
+    canvas.write_tile(tile, pixels)
+
+def render_adaptive(camera, world, threshold=0.1, max_samples=16, canvas=None):
+    # Anti-aliased render that only supersamples pixels on edges. Every
+    # pixel first gets one ray through its centre. Where two neighbouring
+    # pixels hit different objects, or any channel of their colors
+    # (clamped to [0, 1]) differs by more than threshold, both pixels are
+    # re-sampled on a 2x2 grid, then on 4x4, 8x8, ... while their samples
+    # still disagree, up to max_samples samples in the finest grid, so
+    # max_samples must be 1 (no anti-aliasing), 4, 16, 64, ... Returns the
+    # canvas and the average number of rays traced per pixel.
+    n = 1
+    while n * n < max_samples:
+        n *= 2
+    if max_samples < 1 or n * n != max_samples:
+        raise ValueError(f"max_samples must be 1, 4, 16, 64, ..., not {max_samples}")
+    if threshold < 0:
+        raise ValueError("threshold must not be negative")
+    image = canvas if canvas is not None else Canvas(camera.hsize, camera.vsize)
+    if (image.width, image.height) != (camera.hsize, camera.vsize):
+        raise ValueError("Canvas size does not match the camera")
+    width, height = camera.hsize, camera.vsize
+
+    colors = []
+    objects = []
+    for ray in tile_rays(camera, 0, 0, width, height):
+        color, object = _adaptive_sample(world, ray)
+        colors.append(color)
+        objects.append(object)
+
+    edges = bytearray(width * height)
+    for y in range(height):
+        for x in range(width):
+            i = y * width + x
+            for j in ((i + 1,) if x + 1 < width else ()) + ((i + width,) if y + 1 < height else ()):
+                if objects[i] is not objects[j] or _contrast(colors[i], colors[j]) > threshold:
+                    edges[i] = edges[j] = 1
+
+    samples = width * height
+    if max_samples >= 4:
+        for i in range(width * height):
+            if edges[i]:
+                colors[i], count = _supersample(camera, world, i % width, i // width, threshold, max_samples)
+                samples += count
+    write_tile(image, (0, 0, width, height), colors)
+    return image, samples / (width * height)
+
+def _adaptive_sample(world, ray):
+    # The color along ray, as color_at, and the object it hit (or None).
+    if _stats is not None:
+        _stats.primary_rays += 1
+    hit = world.closest_hit(ray)
+    if not hit:
+        return (0.0, 0.0, 0.0), None
+    color = shade_hit(world, prepare_computations(hit, ray))
+    return (color.red, color.green, color.blue), hit.object
+
+def _contrast(a, b):
+    return max(abs(min(max(p, 0), 1) - min(max(q, 0), 1)) for p, q in zip(a, b))
+
+def _supersample(camera, world, x, y, threshold, max_samples):
+    # Mean color of the finest n x n grid of samples taken for pixel (x, y)
+    # and the number of rays traced for it.
+    traced = 0
+    n = 2
+    while n * n <= max_samples:
+        samples = []
+        for j in range(n):
+            for i in range(n):
+                # ray_for_pixel aims at px + 0.5, so shift back by half a pixel.
+                ray = ray_for_pixel(camera, x + (i + 0.5) / n - 0.5, y + (j + 0.5) / n - 0.5)
+                samples.append(_adaptive_sample(world, ray))
+        traced += n * n
+        color = tuple(sum(c[k] for c, _ in samples) / (n * n) for k in range(3))
+        first_color, first_object = samples[0]
+        if all(o is first_object and _contrast(c, first_color) <= threshold for c, o in samples):
+            break
+        n *= 2
+    return color, traced
+
+def canvas_tiles(width, height, tile_size, order="scanline"):
+    # (x0, y0, x1, y1) rectangles covering the canvas, in scanline, Morton
+    # (Z-order) or Hilbert curve order of the tile grid. tile_size is either
+    # a square edge or a (width, height) pair, e.g. (width, 1) for rows.
+    if isinstance(tile_size, tuple):
+        tile_width, tile_height = tile_size
+    else:
+        tile_width = tile_height = tile_size
+    if tile_width < 1 or tile_height < 1:
+        raise ValueError("tile_size must be at least 1")
+    columns = (width + tile_width - 1) // tile_width
+    rows = (height + tile_height - 1) // tile_height
+    grid = [(tx, ty) for ty in range(rows) for tx in range(columns)]
+
+    if order == "morton":
+        grid.sort(key=lambda t: _morton_key(t[0], t[1]))
+    elif order == "hilbert":
+        n = 1
+        while n < max(columns, rows):
+            n *= 2
+        grid.sort(key=lambda t: _hilbert_key(n, t[0], t[1]))
+    elif order != "scanline":
+        raise ValueError(f"Unknown tile order {order!r}")
+
+    return [(tx * tile_width, ty * tile_height,
+             min((tx + 1) * tile_width, width), min((ty + 1) * tile_height, height))
+            for tx, ty in grid]
+
+def _morton_key(x, y):
+    key = 0
+    bit = 0
+    while (x >> bit) or (y >> bit):
+        key |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+        bit += 1
+    return key
+
+def _hilbert_key(n, x, y):
+    d = 0
+    s = n // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s //= 2
+    return d
+
+_worker_scene = None
+_worker_events = []
+
+def _init_render_worker(camera, world, engine, collect_stats=False, collect_trace=False):
+    # Builds the Python engine's BVH up front so it is not charged to the
+    # first tile. The startup span goes back with the first tile rendered.
+    global _worker_scene
+    start = time.time_ns()
+    if engine == "python":
+        world.bvh()
+    _worker_scene = (camera, world, engine, collect_stats, collect_trace)
+    if collect_trace:
+        trace = RenderTrace()
+        trace.add("worker startup", start, engine=engine)
+        _worker_events.extend(trace.events)
+
+def _render_tile_in_worker(tile):
+    # Returns the tile, its pixels and, when the parent is collecting them,
+    # a RenderStats and the trace events for this tile alone for the parent
+    # to merge.
+    camera, world, engine, collect_stats, collect_trace = _worker_scene
+    stats = RenderStats() if collect_stats else None
+    trace = RenderTrace() if collect_trace else None
+    with (stats if stats is not None else contextlib.nullcontext()), \
+            (trace if trace is not None else contextlib.nullcontext()):
+        pixels = render_tile(camera, world, tile, engine)
+    events = None
+    if trace is not None:
+        events = _worker_events + trace.events
+        _worker_events.clear()
+    return tile, pixels, stats, events
+
+# Opt-in render statistics. Inside `with RenderStats() as stats:` the
+# renderer adds to stats; the rest of the time every hook costs a single
+# check of _stats against None. Timings are wall-clock seconds per stage and
+# nest: "render" covers a whole render call, "tile" the tiles (summed over
+# workers), "shade" includes "shadow", and "intersect" is the nearest-hit
+# search of primary rays.
+_stats = None
+
+class RenderStats:
+    def __init__(self):
+        self.primary_rays = 0
+        self.shadow_rays = 0
+        self.shape_tests = collections.Counter()
+        self.inversions = 0
+        self.intersections_lists = 0
+        self.lighting_calls = 0
+        self.timings = collections.Counter()
+        self._previous = None
+
+    def __enter__(self):
+        global _stats
+        self._previous = _stats
+        _stats = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _stats
+        _stats = self._previous
+        self._previous = None
+
+    @property
+    def rays(self):
+        return self.primary_rays + self.shadow_rays
+
+    def merge(self, other):
+        self.primary_rays += other.primary_rays
+        self.shadow_rays += other.shadow_rays
+        self.shape_tests.update(other.shape_tests)
+        self.inversions += other.inversions
+        self.intersections_lists += other.intersections_lists
+        self.lighting_calls += other.lighting_calls
+        self.timings.update(other.timings)
+
+    def as_dict(self):
+        return {
+            "primary_rays": self.primary_rays,
+            "shadow_rays": self.shadow_rays,
+            "shape_tests": dict(self.shape_tests),
+            "inversions": self.inversions,
+            "intersections_lists": self.intersections_lists,
+            "lighting_calls": self.lighting_calls,
+            "timings": dict(self.timings),
+        }
+
+# Opt-in span tracing. Inside `with RenderTrace() as trace:` the renderer
+# records scene setup, worker startup, every tile and image encoding as
+# spans, including those from worker processes, and trace.write(out) saves
+# them as Chrome trace-event JSON for chrome://tracing or Perfetto. Spans
+# use wall-clock time so that different processes share one timeline.
+_trace = None
+
+class RenderTrace:
+    def __init__(self):
+        self.events = []
+        self._previous = None
+
+    def __enter__(self):
+        global _trace
+        self._previous = _trace
+        _trace = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _trace
+        _trace = self._previous
+        self._previous = None
+
+    def add(self, name, start_ns, end_ns=None, **args):
+        # Records a span from start_ns to end_ns (now by default), both from
+        # time.time_ns(), for the calling process and thread.
+        if end_ns is None:
+            end_ns = time.time_ns()
+        self.events.append({"name": name, "ph": "X", "ts": start_ns / 1000, "dur": (end_ns - start_ns) / 1000,
+                            "pid": os.getpid(), "tid": threading.get_native_id(), "args": args})
+
+    def to_json(self):
+        main = os.getpid()
+        names = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+                  "args": {"name": "main" if pid == main else f"worker {pid}"}}
+                 for pid in sorted({event["pid"] for event in self.events})]
+        return {"traceEvents": names + self.events, "displayTimeUnit": "ms"}
+
+    def write(self, out):
+        # out is a text file object.
+        json.dump(self.to_json(), out)
+
+class _ProgressTracker:
+    def __init__(self, callback, total, stats):
+        self.callback = callback
+        self.total = total
+        self.stats = stats
+        self.done = 0
+        self.pixels = 0
+        self.start = time.perf_counter()
+        self.start_shadow_rays = stats.shadow_rays if stats is not None else 0
+
+    def tile_done(self, pixels):
+        self.done += 1
+        self.pixels += pixels
+        rays = self.pixels
+        if self.stats is not None:
+            rays += self.stats.shadow_rays - self.start_shadow_rays
+        elapsed = time.perf_counter() - self.start
+        self.callback(self.done, self.total, rays / elapsed if elapsed > 0 else 0.0)
 
 def is_shadowed(world, point):
+    stats = _stats
+    if stats is not None:
+        stats.shadow_rays += 1
+        start = time.perf_counter()
     v = world.light.position - point
     distance = v.magnitude()
-    direction = v.normalize()
-    r = Ray(point, direction)
-    xs = intersect_world(world,r)
-    h = xs.hit()
-    return h and h.t < distance
+    direction = v.normalize_into()
+    shadowed = world.is_occluded(point, direction, distance)
+    if stats is not None:
+        stats.timings["shadow"] += time.perf_counter() - start
+    return shadowed
 
 def test_shape():
     return Sphere()
@@ -607,11 +2448,436 @@ def test_shape():
 
 class Plane (Shape):
     def local_intersect(self, ray:Ray):
-        if(abs(ray.direction.y) < 0.01):
-            return Intersections()
+        o = ray.origin
+        d = ray.direction
+        return Intersections(*[Intersection(t, self) for t in self.local_ts(o.x, o.y, o.z, d.x, d.y, d.z)])
+
+    def local_ts(self, ox, oy, oz, dx, dy, dz):
+        if(abs(dy) < 0.01):
+            return ()
         else:
-            t = (-ray.origin.y/ray.direction.y)
-            return Intersections(Intersection(t,self))    
+            return (-oy/dy,)
         
     def local_normal_at(self, point):
-        return vector(0,1,0)
\ No newline at end of file
+        return vector(0,1,0)
+
+
+def _union_bounds(shapes):
+    # Smallest BoundingBox around every shape, or None when there are none
+    # or any of them is unbounded.
+    boxes = [shape.bounds() for shape in shapes]
+    if not boxes or any(box is None for box in boxes):
+        return None
+    return BoundingBox(point(min(b.minimum.x for b in boxes), min(b.minimum.y for b in boxes),
+                             min(b.minimum.z for b in boxes)),
+                       point(max(b.maximum.x for b in boxes), max(b.maximum.y for b in boxes),
+                             max(b.maximum.z for b in boxes)))
+
+def _nested_intersection_at(shape, ray, t):
+    # Groups and instances redo the full intersect for the one hit that
+    # gets shaded, so that the Intersection carries its chain of inner hits.
+    xs = shape.intersect(ray)
+    if len(xs) == 0:
+        return Intersection(t, shape)
+    nearest = min(xs, key=lambda x: abs(x.t - t))
+    return Intersection(t, shape, nearest.inner)
+
+class Group(Shape):
+    # Shapes placed in the group's object space, with a BVH of their own.
+    # A group is usually the prototype of many Instances, which all share
+    # that one BVH; it is refit when any shape transform changes.
+    def __init__(self, children=(), transform=identity_matrix, material=Material()):
+        super().__init__(transform, material)
+        self.children = list(children)
+        self._bvh = None
+        self._bvh_generation = None
+
+    def add_child(self, shape):
+        # Moves the group's bounds, so worlds holding it must refit too.
+        self.children.append(shape)
+        self._bvh = None
+        Shape.generation += 1
+
+    def bvh(self):
+        bvh = self._bvh
+        if bvh is None or len(bvh.objects) != len(self.children):
+            bvh = self._bvh = BVH(self.children)
+            self._bvh_generation = Shape.generation
+        elif self._bvh_generation != Shape.generation:
+            bvh.refit()
+            self._bvh_generation = Shape.generation
+        return bvh
+
+    def local_ts(self, ox, oy, oz, dx, dy, dz):
+        ray = Ray(point(ox, oy, oz), vector(dx, dy, dz))
+        ts = []
+        for child in self.bvh().traverse(ray):
+            ts.extend(child.intersect_ts(ray))
+        return tuple(ts)
+
+    def local_intersect(self, ray):
+        xs = []
+        for child in self.bvh().traverse(ray):
+            xs.extend(Intersection(x.t, self, x) for x in child.intersect(ray))
+        return Intersections(*xs)
+
+    def intersection_at(self, ray, t):
+        return _nested_intersection_at(self, ray, t)
+
+    def local_normal_at(self, local_point, inner=None):
+        if inner is None:
+            raise ValueError("A group's normal depends on which child was hit; pass the intersection")
+        return inner.object.normal_at(local_point, inner)
+
+    def local_bounds(self):
+        return _union_bounds(self.children)
+
+    def bounds(self):
+        # Not cached, since it changes whenever a child moves.
+        local = self.local_bounds()
+        return None if local is None else local.transform(self._transform)
+
+class Instance(Shape):
+    # A placement of a shared prototype shape or Group: only a transform,
+    # its inverse and an optional material. The prototype is intersected in
+    # the instance's object space, so its geometry, its own transform and
+    # (for a group) its BVH are shared by every instance.
+    #
+    # The transform must be affine. Its top three rows and those of its
+    # inverse are kept as 24 doubles in one array instead of Matrix4 objects
+    # of boxed floats; the matrix properties build Matrix4 values on demand,
+    # and intersect_ts and normal_at read the array directly.
+    __slots__ = ("prototype", "_material", "_affine")
+
+    def __init__(self, prototype, transform=identity_matrix, material=None):
+        self.prototype = prototype
+        self._material = material
+        self.transform = transform
+
+    @property
+    def transform(self):
+        return Matrix4(tuple(self._affine[0:12]) + (0.0, 0.0, 0.0, 1.0))
+
+    @transform.setter
+    def transform(self, t):
+        m = Matrix4.from_matrix(t).m
+        if m[12:16] != (0, 0, 0, 1):
+            raise ValueError("Instance transforms must be affine")
+        inverse = Matrix4.from_matrix(t.inverse()).m
+        self._affine = array("d", m[0:12] + inverse[0:12])
+        Shape.generation += 1
+
+    @property
+    def inverse_transform(self):
+        return Matrix4(tuple(self._affine[12:24]) + (0.0, 0.0, 0.0, 1.0))
+
+    @property
+    def inverse_transpose(self):
+        return self.inverse_transform.transpose()
+
+    @property
+    def material(self):
+        # The override, or else the prototype's material.
+        if self._material is None:
+            return self.prototype.material
+        return self._material
+
+    @material.setter
+    def material(self, material):
+        self._material = material
+
+    def intersect(self, ray):
+        # As Shape.intersect, without keeping the transformed ray alive.
+        if _stats is not None:
+            _stats.shape_tests["Instance"] += 1
+        return self.local_intersect(ray.transform(self.inverse_transform))
+
+    def intersect_ts(self, ray):
+        if _stats is not None:
+            _stats.shape_tests["Instance"] += 1
+        a = self._affine
+        o = ray.origin
+        d = ray.direction
+        ox = a[12] * o.x + a[13] * o.y + a[14] * o.z + a[15] * o.w
+        oy = a[16] * o.x + a[17] * o.y + a[18] * o.z + a[19] * o.w
+        oz = a[20] * o.x + a[21] * o.y + a[22] * o.z + a[23] * o.w
+        dx = a[12] * d.x + a[13] * d.y + a[14] * d.z + a[15] * d.w
+        dy = a[16] * d.x + a[17] * d.y + a[18] * d.z + a[19] * d.w
+        dz = a[20] * d.x + a[21] * d.y + a[22] * d.z + a[23] * d.w
+        return self.local_ts(ox, oy, oz, dx, dy, dz)
+
+    def local_ts(self, ox, oy, oz, dx, dy, dz):
+        return self.prototype.intersect_ts(Ray(point(ox, oy, oz), vector(dx, dy, dz)))
+
+    def local_intersect(self, ray):
+        return Intersections(*[Intersection(x.t, self, x) for x in self.prototype.intersect(ray)])
+
+    def normal_at(self, world_point, hit=None):
+        a = self._affine
+        x, y, z, w = world_point.x, world_point.y, world_point.z, world_point.w
+        object_point = Tuple(a[12] * x + a[13] * y + a[14] * z + a[15] * w,
+                             a[16] * x + a[17] * y + a[18] * z + a[19] * w,
+                             a[20] * x + a[21] * y + a[22] * z + a[23] * w, w)
+        if hit is None or hit.inner is None:
+            n = self.local_normal_at(object_point)
+        else:
+            n = self.local_normal_at(object_point, hit.inner)
+        # Rows of the inverse transpose are columns of the inverse.
+        return Tuple(a[12] * n.x + a[16] * n.y + a[20] * n.z,
+                     a[13] * n.x + a[17] * n.y + a[21] * n.z,
+                     a[14] * n.x + a[18] * n.y + a[22] * n.z, 0).normalize_into()
+
+    def local_intersect_batch(self, origins, directions):
+        _require_numpy()
+        inverse = np.asarray(Matrix4.from_matrix(self.prototype.inverse_transform).m).reshape(4, 4)
+        return self.prototype.local_intersect_batch(origins @ inverse.T, directions @ inverse.T)
+
+    def intersection_at(self, ray, t):
+        return _nested_intersection_at(self, ray, t)
+
+    def local_normal_at(self, local_point, inner=None):
+        if inner is None:
+            return self.prototype.normal_at(local_point)
+        return inner.object.normal_at(local_point, inner)
+
+    def local_bounds(self):
+        return self.prototype.bounds()
+
+    def bounds(self):
+        # Not cached, since the prototype may move.
+        local = self.local_bounds()
+        return None if local is None else local.transform(self.transform)
+
+
+# Vectorized engine. Rays are stored as (n, 4) arrays of homogeneous
+# coordinates (points have w=1, vectors w=0) and every stage below mirrors
+# the scalar function of the same name, one array operation per step.
+
+_batch_intersect_kernels = {}
+
+def register_batch_intersect(shape_type):
+    # Decorator registering kernel(shape, origins, directions) -> (t0, t1)
+    # as the batch intersection of shape_type and its subclasses.
+    def decorator(kernel):
+        _batch_intersect_kernels[shape_type] = kernel
+        return kernel
+    return decorator
+
+def batch_intersect_kernel(shape_type):
+    # A subclass that overrides local_intersect no longer matches its
+    # parent's kernel and falls back to the scalar path.
+    for cls in shape_type.__mro__:
+        if cls in _batch_intersect_kernels:
+            return _batch_intersect_kernels[cls]
+        if "local_intersect" in cls.__dict__:
+            return None
+    return None
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("The numpy render engine requires numpy to be installed")
+
+def _dot3(a, b):
+    return a[:, 0] * b[:, 0] + a[:, 1] * b[:, 1] + a[:, 2] * b[:, 2]
+
+def _normalize_rows(v):
+    magnitude = np.sqrt(v[:, 0] * v[:, 0] + v[:, 1] * v[:, 1] + v[:, 2] * v[:, 2] + v[:, 3] * v[:, 3])
+    result = v / magnitude[:, None]
+    result[:, 3] = v[:, 3]
+    return result
+
+def primary_rays_numpy(camera, x0, y0, x1, y1):
+    # Row-major (origins, directions) arrays, equal element for element to
+    # ray_for_pixel (see _camera_row).
+    m = camera.inverse_transform.m
+    origin = camera.origin
+    world_x = camera.half_width - (np.arange(x0, x1, dtype=float) + 0.5) * camera.pixel_size
+    world_y = camera.half_height - (np.arange(y0, y1, dtype=float) + 0.5) * camera.pixel_size
+    columns = np.stack([m[0] * world_x, m[4] * world_x, m[8] * world_x, m[12] * world_x], axis=1)
+    rows = np.stack([m[1] * world_y - m[2] + m[3] - origin.x,
+                     m[5] * world_y - m[6] + m[7] - origin.y,
+                     m[9] * world_y - m[10] + m[11] - origin.z,
+                     m[13] * world_y - m[14] + m[15] - origin.w], axis=1)
+    directions = _normalize_rows((columns[None, :, :] + rows[:, None, :]).reshape(-1, 4))
+    origins = np.tile(np.array([origin.x, origin.y, origin.z, origin.w]), (len(directions), 1))
+    return origins, directions
+
+@register_batch_intersect(Sphere)
+def sphere_intersect_batch(sphere, origins, directions):
+    center = np.array([sphere.center.x, sphere.center.y, sphere.center.z])
+    sphere_to_ray = origins[:, :3] - center
+    a = _dot3(directions, directions)
+    b = 2 * _dot3(sphere_to_ray, directions)
+    c = _dot3(sphere_to_ray, sphere_to_ray) - sphere.radius * sphere.radius
+    discriminant = b * b - 4 * a * c
+    miss = discriminant < 0
+    root = np.sqrt(np.where(miss, 0, discriminant))
+    t0 = np.where(miss, np.nan, (-b - root) / (2 * a))
+    t1 = np.where(miss, np.nan, (-b + root) / (2 * a))
+    return t0, t1
+
+@register_batch_intersect(Plane)
+def plane_intersect_batch(plane, origins, directions):
+    dy = directions[:, 1]
+    parallel = np.abs(dy) < 0.01
+    t0 = np.where(parallel, np.nan, -origins[:, 1] / np.where(parallel, 1, dy))
+    return t0, np.full(len(origins), np.nan)
+
+def _compiled_scene(world):
+    return world if isinstance(world, CompiledScene) else world.compile()
+
+def _group_matrices(values, rows):
+    return np.asarray(values).reshape(-1, 4, 4)[rows]
+
+def _transform_rows(matrices, points):
+    # Row i of the result is matrices[i] * points[i].
+    return np.einsum("nij,nj->ni", matrices, points)
+
+def _closed_form_normal(shape_type):
+    # Whether shape_type uses Sphere's or Plane's own local_normal_at, which
+    # _local_normal_numpy evaluates as one array expression for all rows.
+    return shape_type.local_normal_at in (Sphere.local_normal_at, Plane.local_normal_at)
+
+def _local_normal_numpy(shape, points):
+    local_normal_at = type(shape).local_normal_at
+    if local_normal_at is Sphere.local_normal_at:
+        return points - np.array([0.0, 0.0, 0.0, 1.0])
+    if local_normal_at is Plane.local_normal_at:
+        return np.broadcast_to(np.array([0.0, 1.0, 0.0, 0.0]), points.shape).copy()
+    normals = np.empty_like(points)
+    for i, p in enumerate(points):
+        n = shape.local_normal_at(Tuple(*p))
+        normals[i] = (n.x, n.y, n.z, n.w)
+    return normals
+
+def _nearest_hits_numpy(scene, origins, directions):
+    # For every ray, the smallest non-negative t over all objects and the
+    # index of the object it belongs to (-1 and inf on a miss). Ties go to
+    # the earlier object, like Intersections.hit on the sorted list.
+    count = len(origins)
+    best_t = np.full(count, np.inf)
+    best_index = np.full(count, -1)
+    for group in scene.groups:
+        inverses = np.asarray(group.inverse_transforms).reshape(-1, 4, 4)
+        if _stats is not None:
+            _stats.shape_tests[group.shape_type.__name__] += len(group.shapes) * count
+        for row, shape in enumerate(group.shapes):
+            index = group.indices[row]
+            inverse = inverses[row]
+            t0, t1 = shape.local_intersect_batch(origins @ inverse.T, directions @ inverse.T)
+            t = np.where(t0 >= 0, t0, np.where(t1 >= 0, t1, np.inf))
+            closer = (t < best_t) | ((t == best_t) & (index < best_index))
+            best_t[closer] = t[closer]
+            best_index[closer] = index
+    return best_t, best_index
+
+def color_at_numpy(world, origins, directions):
+    # world may be a World or the CompiledScene of one.
+    scene = _compiled_scene(world)
+    count = len(origins)
+    colors = np.zeros((count, 3))
+    t, hit_index = _nearest_hits_numpy(scene, origins, directions)
+    hit = np.nonzero(hit_index >= 0)[0]
+    if len(hit) == 0:
+        return colors
+
+    origins = origins[hit]
+    directions = directions[hit]
+    hit_index = hit_index[hit]
+    points = origins + directions * t[hit][:, None]
+    eyev = -directions
+
+    # prepare_computations, one shape type at a time
+    hit_groups = np.asarray(scene.group_ids)[hit_index]
+    hit_rows = np.asarray(scene.rows)[hit_index]
+    normals = np.empty_like(points)
+    materials = np.empty((len(hit), len(MATERIAL_FIELDS)))
+    pattern_ids = np.empty(len(hit), dtype=int)
+    inverses = np.empty((len(hit), 4, 4))
+    for number, group in enumerate(scene.groups):
+        mask = hit_groups == number
+        if not mask.any():
+            continue
+        rows = hit_rows[mask]
+        inverses[mask] = _group_matrices(group.inverse_transforms, rows)
+        object_points = _transform_rows(inverses[mask], points[mask])
+        if _closed_form_normal(group.shape_type):
+            local_normals = _local_normal_numpy(group.shapes[0], object_points)
+        else:
+            local_normals = np.empty_like(object_points)
+            for row in np.unique(rows):
+                same = rows == row
+                local_normals[same] = _local_normal_numpy(group.shapes[row], object_points[same])
+        world_normals = _transform_rows(_group_matrices(group.inverse_transposes, rows), local_normals)
+        world_normals[:, 3] = 0
+        normals[mask] = _normalize_rows(world_normals)
+        materials[mask] = np.asarray(group.materials).reshape(-1, len(MATERIAL_FIELDS))[rows]
+        pattern_ids[mask] = np.asarray(group.pattern_ids)[rows]
+    inside = _dot3(normals, eyev) < 0
+    normals[inside] = -normals[inside]
+
+    # shade_hit
+    over_points = points + normals * 0.001
+    light_position = np.asarray(scene.light_position)
+    v = light_position - over_points
+    distance = np.sqrt(v[:, 0] * v[:, 0] + v[:, 1] * v[:, 1] + v[:, 2] * v[:, 2] + v[:, 3] * v[:, 3])
+    if _stats is not None:
+        _stats.shadow_rays += len(hit)
+        _stats.lighting_calls += len(hit)
+    shadow_t, _ = _nearest_hits_numpy(scene, over_points, _normalize_rows(v))
+    in_shadow = shadow_t < distance
+
+    # lighting
+    intensity = np.asarray(scene.light_intensity)
+    surface = materials[:, 0:3].copy()
+    ambient, diffuse, specular, shininess = materials[:, 3:7].T
+    for pattern_id in np.unique(pattern_ids[pattern_ids >= 0]):
+        mask = pattern_ids == pattern_id
+        pattern = scene.patterns[pattern_id]
+        object_points = _transform_rows(inverses[mask], over_points[mask])
+        pattern_points = pattern.inverse_transform.transform_points(object_points)
+        surface[mask] = pattern.pattern_at_batch(pattern_points)
+
+    colors[hit] = lighting_batch(light_position, intensity, over_points, eyev, normals, in_shadow,
+                                 surface, ambient, diffuse, specular, shininess)
+    return colors
+
+def lighting_batch(light_position, light_intensity, points, eyev, normalv, in_shadow,
+                   colors, ambient, diffuse, specular, shininess):
+    # lighting for n hits at once: points, eyev and normalv are (n, 4)
+    # arrays, in_shadow is n booleans, colors the (n, 3) surface colors
+    # (material color or pattern result) and the material parameters are n
+    # values each or scalars. light_position and light_intensity are the
+    # 4 coordinates and 3 channels of the light. Returns (n, 3) colors equal
+    # to the scalar lighting of each hit, operation for operation.
+    _require_numpy()
+    light_position = np.asarray(light_position, dtype=float)
+    points = np.asarray(points, dtype=float)
+    eyev = np.asarray(eyev, dtype=float)
+    normalv = np.asarray(normalv, dtype=float)
+    in_shadow = np.asarray(in_shadow, dtype=bool)
+    effective = np.asarray(light_intensity, dtype=float) * np.asarray(colors, dtype=float)
+    count = len(points)
+    ambient, diffuse, specular, shininess = (np.broadcast_to(np.asarray(value, dtype=float), (count,))[:, None]
+                                             for value in (ambient, diffuse, specular, shininess))
+
+    l = light_position - points
+    magnitude = np.sqrt(l[:, 0] * l[:, 0] + l[:, 1] * l[:, 1] + l[:, 2] * l[:, 2] + l[:, 3] * l[:, 3])
+    lx, ly, lz = l[:, 0] / magnitude, l[:, 1] / magnitude, l[:, 2] / magnitude
+    nx, ny, nz = normalv[:, 0], normalv[:, 1], normalv[:, 2]
+    light_dot_normal = np.maximum(lx * nx + ly * ny + lz * nz, 0)
+
+    # reflect(-light_v, normalv) . eyev, as in lighting
+    d = -lx * nx + -ly * ny + -lz * nz
+    reflect_dot_eye = ((-lx - nx * 2 * d) * eyev[:, 0] + (-ly - ny * 2 * d) * eyev[:, 1]
+                       + (-lz - nz * 2 * d) * eyev[:, 2])
+    specular_factor = np.power(np.maximum(reflect_dot_eye, 0), shininess[:, 0])
+
+    lit = (effective * ambient + effective * diffuse * light_dot_normal[:, None]
+           + effective * specular * specular_factor[:, None])
+    return np.where(in_shadow[:, None], effective * ambient, lit)
+
+def render_region_numpy(camera, world, x0, y0, x1, y1):
+    _require_numpy()
+    origins, directions = primary_rays_numpy(camera, x0, y0, x1, y1)
+    return color_at_numpy(world, origins, directions).reshape(y1 - y0, x1 - x0, 3)
@@ -0,0 +1,45 @@
+import sys
+from collections import Counter
+
+import Tuple
+from multiple3d import scene
+from Tuple import render
+
+# Counts how many renderer value objects are constructed per pixel while
+# rendering a small version of the multiple3d.py scene.
+TRACKED = ["Tuple", "Color", "Ray", "Intersection", "Intersections", "Computations", "Matrix4"]
+
+
+def count_allocations(camera, world):
+    counts = Counter()
+    originals = {}
+    for name in TRACKED:
+        cls = getattr(Tuple, name)
+        originals[name] = cls.__init__
+
+        def counting_init(self, *args, _name=name, _init=cls.__init__, **kwargs):
+            if type(self).__name__ == _name:
+                counts[_name] += 1
+            _init(self, *args, **kwargs)
+        cls.__init__ = counting_init
+    try:
+        render(camera, world)
+    finally:
+        for name in TRACKED:
+            getattr(Tuple, name).__init__ = originals[name]
+    return counts
+
+
+def main():
+    camera, world = scene(50, 25)
+    render(camera, world)
+    counts = count_allocations(camera, world)
+    pixels = camera.hsize * camera.vsize
+    for name in TRACKED:
+        print(f"{name:>14}: {counts[name] / pixels:8.2f} per pixel")
+    print(f"{'total':>14}: {sum(counts.values()) / pixels:8.2f} per pixel")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,6 @@
 from math import pi
 
-from Tuple import (Canvas, Color, Matrix,Tuple,canvas_to_ppm)
+from Tuple import (Canvas, Color, Matrix,Tuple,write_ppm)
 
 
 def main():
@@ -11,17 +11,17 @@ def main():
     translate = Matrix.translation(250, 0, 250)
     scale = Matrix.scaling(100, 0, 100)
 
-    for h in range(12):
-        r = Matrix.rotation_y(h * pi / 6)
-        transform =translate * (scale * r)
-        p2 = transform * p
+    # The twelve hour marks on the unit circle, then all of them placed on
+    # the canvas in one call.
+    hours = [Matrix.rotation_y(h * pi / 6) * p for h in range(12)]
+    for p2 in (translate * scale).transform_points(hours):
         print(f"position ({p2.x}, {p2.y}, {p2.z})")
         print(c.height)
         c.write_pixel(round(p2.x), c.height - round(p2.z),
                     Color(0.0, 1.0, 0.0))
 
-    with open('clock.ppm', 'w') as out_file:
-        out_file.write(canvas_to_ppm(c))
+    with open('clock.ppm', 'wb') as out_file:
+        write_ppm(c, out_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,257 @@
+import argparse
+import importlib
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from Tuple import (Camera, Color, Instance, Material, Matrix, Plane, PointLight, RenderStats, Sphere, World,
+                   default_world, np, point, render, vector, view_transform)
+
+# End-to-end render benchmarks. Every configuration (scene, engine, workers)
+# is measured in a fresh Python process, so that its peak memory figures
+# are its own: it is rendered once untimed to count rays and trace peak
+# memory, then timed --repeat times, keeping the fastest run. Results are
+# printed as a table and can be written to JSON and compared against an
+# earlier JSON file.
+#
+#   python benchmark.py --output baseline.json
+#   python benchmark.py --baseline baseline.json
+
+SCALE = 0.2
+
+
+def _sized(module, hsize, vsize):
+    return importlib.import_module(module).scene(hsize, vsize)
+
+
+def default_world_scene(hsize, vsize):
+    camera = Camera(hsize, vsize, math.pi / 3)
+    camera.transform = view_transform(point(0, 0, -5), point(0, 0, 0), vector(0, 1, 0))
+    return camera, default_world()
+
+
+def many_spheres_scene(count, instanced=False):
+    # count small spheres scattered above a floor plane, with a fixed seed
+    # so that every run traces the same scene. With instanced=True they are
+    # Instances of one shared unit sphere.
+    def build(hsize, vsize):
+        rng = random.Random(count)
+        world = World(light=PointLight(point(-10, 10, -10), Color(1, 1, 1)))
+        world.add_object(Plane())
+        prototype = Sphere()
+        for _ in range(count):
+            sphere = Instance(prototype) if instanced else Sphere()
+            sphere.transform = (Matrix.translation(rng.uniform(-6, 6), rng.uniform(0.2, 4), rng.uniform(-2, 10))
+                                * Matrix.scaling(0.2, 0.2, 0.2))
+            sphere.material = Material(color=Color(rng.random(), rng.random(), rng.random()), diffuse=0.7,
+                                       specular=0.3)
+            world.add_object(sphere)
+        camera = Camera(hsize, vsize, math.pi / 3)
+        camera.transform = view_transform(point(0, 2, -8), point(0, 1, 0), vector(0, 1, 0))
+        return camera, world
+    return build
+
+
+# name -> (builder(hsize, vsize) -> (camera, world), full-size width, height)
+SCENES = {
+    "default_world": (default_world_scene, 200, 200),
+    "multiple3d": (lambda h, v: _sized("multiple3d", h, v), 500, 250),
+    "planeobjects3d": (lambda h, v: _sized("planeobjects3d", h, v), 500, 250),
+    "spheres100": (many_spheres_scene(100), 400, 200),
+    "spheres1000": (many_spheres_scene(1000), 400, 200),
+    "instances1000": (many_spheres_scene(1000, instanced=True), 400, 200),
+}
+
+# 3dsphere.py and circle.py cast their rays by hand instead of going
+# through a camera, so they only run on the Python engine and their ray
+# count is one primary ray per pixel.
+SCRIPTS = {
+    "3dsphere": ("3dsphere", 100),
+    "circle": ("circle", 100),
+}
+
+
+def _max_rss_kb(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    rss = resource.getrusage(who).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def measure(run, repeat):
+    # run() renders once. Returns the RenderStats of the first run, the
+    # traced peak of this process's Python allocations during it and the
+    # best wall time over repeat more runs.
+    tracemalloc.start()
+    try:
+        with RenderStats() as stats:
+            run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return stats, peak, best
+
+
+def _configurations(args):
+    for name in args.scenes:
+        if name in SCRIPTS:
+            yield {"scene": name, "engine": "python", "workers": 1}
+            continue
+        for engine in args.engines:
+            for workers in args.workers:
+                yield {"scene": name, "engine": engine, "workers": workers}
+
+
+def measure_configuration(config, scale, tile_size, repeat):
+    # Builds and measures one configuration in this process; see
+    # run_benchmarks.
+    name, engine, workers = config["scene"], config["engine"], config["workers"]
+    if name in SCRIPTS:
+        module, pixels = SCRIPTS[name]
+        hsize = vsize = max(1, round(pixels * scale))
+        draw = importlib.import_module(module).draw
+        run = lambda: draw(hsize)
+        primary = hsize * vsize
+    else:
+        build, hsize, vsize = SCENES[name]
+        hsize, vsize = max(1, round(hsize * scale)), max(1, round(vsize * scale))
+        camera, world = build(hsize, vsize)
+        run = lambda: render(camera, world, engine=engine, workers=workers, tile_size=tile_size)
+        primary = None
+    stats, traced_peak, seconds = measure(run, repeat)
+    primary = primary if primary is not None else stats.primary_rays
+    shadow = stats.shadow_rays
+    return {
+        "scene": name,
+        "engine": engine,
+        "workers": workers,
+        "width": hsize,
+        "height": vsize,
+        "seconds": seconds,
+        "primary_rays": primary,
+        "shadow_rays": shadow,
+        "rays_per_second": (primary + shadow) / seconds if seconds else math.inf,
+        "traced_peak_kb": traced_peak // 1024,
+        "max_rss_kb": _max_rss_kb(resource.RUSAGE_SELF),
+        "children_max_rss_kb": _max_rss_kb(resource.RUSAGE_CHILDREN),
+        "shape_tests": dict(stats.shape_tests),
+        "inversions": stats.inversions,
+        "lighting_calls": stats.lighting_calls,
+    }
+
+
+def run_benchmarks(args):
+    # ru_maxrss is a high-water mark for the whole process, so each
+    # configuration runs in a child process of its own.
+    results = []
+    for config in _configurations(args):
+        command = [sys.executable, os.path.abspath(__file__), "--measure", json.dumps(config),
+                   "--scale", str(args.scale), "--tile-size", str(args.tile_size), "--repeat", str(args.repeat)]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.append(json.loads(output.splitlines()[-1]))
+        if not args.quiet:
+            _print_row(results[-1])
+    return results
+
+
+def _key(result):
+    return result["scene"], result["engine"], result["workers"], result["width"], result["height"]
+
+
+def compare(results, baseline, tolerance):
+    # A configuration regresses when it is slower than tolerance allows or
+    # traces a different number of rays than the baseline.
+    previous = {_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(_key(result))
+        if old is None:
+            continue
+        result["baseline_seconds"] = old["seconds"]
+        result["speedup"] = old["seconds"] / result["seconds"] if result["seconds"] else math.inf
+        if result["seconds"] > old["seconds"] * (1 + tolerance):
+            regressions.append(f"{_label(result)}: {old['seconds']:.3f}s -> {result['seconds']:.3f}s")
+        for field in ("primary_rays", "shadow_rays"):
+            if result[field] != old[field]:
+                regressions.append(f"{_label(result)}: {field} {old[field]} -> {result[field]}")
+    return regressions
+
+
+def _label(result):
+    return f"{result['scene']} [{result['engine']}, {result['workers']} worker(s), {result['width']}x{result['height']}]"
+
+
+def _print_row(result):
+    print(f"{_label(result):<55} {result['seconds']:8.3f}s {result['rays_per_second']:12.0f} rays/s"
+          f"  primary {result['primary_rays']:>8}  shadow {result['shadow_rays']:>8}"
+          f"  peak {result['traced_peak_kb']:>7} KB")
+
+
+def parse_args(argv):
+    engines = ["python", "numpy"] if np is not None else ["python"]
+    parser = argparse.ArgumentParser(description="Render benchmark suite")
+    parser.add_argument("--scenes", nargs="+", default=list(SCENES) + list(SCRIPTS),
+                        choices=list(SCENES) + list(SCRIPTS))
+    parser.add_argument("--engines", nargs="+", default=engines, choices=["python", "numpy"])
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, os.cpu_count() or 1])
+    parser.add_argument("--scale", type=float, default=SCALE,
+                        help="image size relative to each scene's full size (default %(default)s)")
+    parser.add_argument("--tile-size", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON file from an earlier --output run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed slowdown against the baseline before it counts as a regression")
+    parser.add_argument("--quiet", action="store_true")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    args.workers = sorted(set(args.workers))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.measure:
+        print(json.dumps(measure_configuration(json.loads(args.measure), args.scale, args.tile_size, args.repeat)))
+        return 0
+    results = run_benchmarks(args)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__ if np is not None else None,
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+        for result in results:
+            if "speedup" in result:
+                print(f"{_label(result):<55} {result['speedup']:6.2f}x vs baseline")
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        status = 1 if regressions else 0
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
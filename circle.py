@@ -1,10 +1,9 @@
-from Tuple import Tuple,Color,Canvas,Sphere,Ray,Intersection,Intersections, canvas_to_ppm
+from Tuple import Tuple,Color,Canvas,Sphere,Ray,Intersection,Intersections, write_ppm
 
-def main():
+def draw(canvas_pixels=100):
     ray_origin = Tuple(0, 0, -5, 1)
     wall_z = 10
     wall_size = 7.0
-    canvas_pixels = 100
     pixel_size = wall_size / canvas_pixels
     half = wall_size / 2
     canvas = Canvas(canvas_pixels, canvas_pixels) 
@@ -21,10 +20,12 @@ def main():
             xs = shape.intersect(r)
             if xs.hit():
                 canvas.write_pixel( x, y, color)
+    return canvas
 
-    
-    with open('output.ppm', 'w') as out_file:
-        out_file.write(canvas_to_ppm(canvas))            
+def main():
+    canvas = draw()
+    with open('output.ppm', 'wb') as out_file:
+        write_ppm(canvas, out_file)            
 
   
 
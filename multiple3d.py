@@ -1,8 +1,10 @@
+import argparse
+import contextlib
 import math
 from Tuple import *
 # ... (previous definitions for `Matrix`, `Tuple`, `Color`, `Ray`, `Sphere`, `World`, `Intersection`, `Computations`, `lighting`, `prepare_computations`, `ray_for_pixel`, and `render` functions)
 
-def main():
+def scene(hsize=500, vsize=250):
     # Create the world and objects
     world = World()
     light = PointLight(Tuple(-10, 10, -10, 1), Color(1, 1, 1))
@@ -11,25 +13,25 @@ def main():
     # Add objects to the world
     floor = Sphere()
     floor.material = Material()
-    floor.transform = Matrix.scaling(10, 0.01, 10)
+    floor.transform = Transform().scale(10, 0.01, 10)
     floor.material.color = Color(1, 0.9, 0.9)
     floor.material.specular = 0
     world.add_object(floor)
 
     left_wall = Sphere()
     left_wall.material = floor.material
-    left_wall.transform = Matrix.translation(0,0,5) *  Matrix.rotation_y(-math.pi/4) * Matrix.rotation_x(math.pi/2) *Matrix.scaling(10, 0.01, 10)
+    left_wall.transform = Transform().scale(10, 0.01, 10).rotate_x(math.pi/2).rotate_y(-math.pi/4).translate(0,0,5)
    
     world.add_object(left_wall)
 
     right_wall = Sphere()
     right_wall.material = floor.material
-    right_wall.transform = Matrix.translation(0,0,5) *  Matrix.rotation_y(math.pi/4) * Matrix.rotation_x(math.pi/2) *Matrix.scaling(10, 0.01, 10)
+    right_wall.transform = Transform().scale(10, 0.01, 10).rotate_x(math.pi/2).rotate_y(math.pi/4).translate(0,0,5)
    
     world.add_object(right_wall)
 
     middle= Sphere()
-    middle.transform = Matrix.translation(-0.5,1,0.5)
+    middle.transform = Transform().translate(-0.5,1,0.5)
     middle.material = Material()
     middle.material.color = Color(0.1, 1, 0.5)
     middle.material.diffuse = 0.7
@@ -37,7 +39,7 @@ def main():
     world.add_object(middle)
 
     right= Sphere()
-    right.transform = Matrix.translation(1.5,0.5,-0.5)*Matrix.scaling(0.5,0.5,0.5)
+    right.transform = Transform().scale(0.5,0.5,0.5).translate(1.5,0.5,-0.5)
     right.material = Material()
     right.material.color = Color(0.5, 1, 0.1)
     right.material.diffuse = 0.7
@@ -45,7 +47,7 @@ def main():
 
 
     left= Sphere()
-    left.transform = Matrix.translation(1.5,0.33,-0.75)*Matrix.scaling(0.33,0.33,0.33)
+    left.transform = Transform().scale(0.33,0.33,0.33).translate(1.5,0.33,-0.75)
     left.material = Material()
     left.material.color = Color(1, 0.8, 0.1)
     left.material.diffuse = 0.7
@@ -56,15 +58,35 @@ def main():
 
     world.light = PointLight(point(-10,10,-10),Color(1,1,1))
     # Create the camera
-    camera = Camera(500, 250, math.pi / 3)
+    camera = Camera(hsize, vsize, math.pi / 3)
     camera.transform = view_transform(Tuple(0, 1.5, -5, 1), Tuple(0, 1, 0, 1), Tuple(0, 1, 0, 0))
+    return camera, world
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--trace", help="also write a Chrome trace of the render to this file")
+    parser.add_argument("--max-samples", type=int, default=1,
+                        help="anti-alias edges with up to this many samples per pixel (1, 4, 16, 64, ...)")
+    args = parser.parse_args()
+
+    with RenderTrace() if args.trace else contextlib.nullcontext() as trace:
+        camera, world = scene()
+
+        # Render the scene
+        if args.max_samples > 1:
+            canvas, samples = render_adaptive(camera, world, max_samples=args.max_samples)
+            print(f"{samples:.2f} samples per pixel")
+        else:
+            canvas = render(camera, world, workers=args.workers)
 
-    # Render the scene
-    canvas = render(camera, world)
+        # Write the image to a PPM file
+        with open("multiple3d.ppm", "wb") as f:
+            write_ppm(canvas, f)
 
-    # Write the image to a PPM file
-    with open("multiple3d.ppm", "w") as f:
-        f.write(canvas_to_ppm(canvas))
+    if args.trace:
+        with open(args.trace, "w") as f:
+            trace.write(f)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file